@@ -3,6 +3,7 @@ Send JPEG image to aquila_inference server for Regression.
 """
 
 import os
+import Queue
 import sys
 import threading
 
@@ -25,6 +26,17 @@ tf.app.flags.DEFINE_string('server', 'localhost:9000',
                            'aquila_inference service host:port')
 tf.app.flags.DEFINE_string('image', '', 'path to image in JPEG format')
 tf.app.flags.DEFINE_string('image_list_file', '', 'path to a text file containing a list of images')
+tf.app.flags.DEFINE_boolean('bulk', False,
+                            'decode images at reduced resolution in a pool '
+                            'of threads that feeds the inference requests')
+tf.app.flags.DEFINE_integer('decode_threads', 4,
+                            'number of image decoding threads in bulk mode')
+tf.app.flags.DEFINE_integer('queue_size', 64,
+                            'maximum number of decoded images waiting to be '
+                            'sent in bulk mode')
+tf.app.flags.DEFINE_boolean('save_arrays', True,
+                            'save each preprocessed image as a .npy file '
+                            'next to the image')
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -76,7 +88,25 @@ def _resize_to(img, w=None, h=None):
   # return img.resize((w, h), Image.BILINEAR)
   return img.resize((w, h), Image.ANTIALIAS)
 
-def _read_image(imagefn):
+def _draft_size(w, h, asp=16./9, size=299):
+  '''
+  Returns the smallest size that an image can be decoded at such that,
+  once padded to the aspect ratio, both dimensions are at least the
+  target size.
+
+  Args:
+    w: The width of the image.
+    h: The height of the image.
+    asp: The aspect ratio the image will be padded to, as w / h.
+    size: The size the padded image will be resized to.
+  '''
+  if float(w) / h > asp:
+    # the image will be padded in height, so its width must cover both.
+    return (int(np.ceil(size * asp)), 1)
+  return (1, size)
+
+
+def _read_image(imagefn, draft=False):
   '''
   This function reads in an image as a raw file and then converts
   it to a PIL image. Note that, critically, PIL must be imported before
@@ -84,6 +114,8 @@ def _read_image(imagefn):
 
   Args:
     imagefn: A fully-qualified path to an image as a string.
+    draft: If True, JPEGs are decoded at the smallest scale that is still
+      large enough to be prepped for Aquila, which is much faster.
 
   Returns:
     The PIL image requested.
@@ -94,6 +126,8 @@ def _read_image(imagefn):
     warn('Problem opening %s with PIL, error: %s' % (imagefn, e.message))
     return None
   try:
+    if draft:
+      pil_image.draft('RGB', _draft_size(*pil_image.size))
     # ensure that the image file is closed.
     pil_image.load()
   except Exception, e:
@@ -196,12 +230,12 @@ def _pad_to_asp(img, asp):
   return nimg
 
 
-def prep_aquila(image_file):
+def prep_aquila(image_file, draft=False):
   '''
   Preprocesses an image from a fully-qualified file.
   '''
   # Load the image.
-  image = _read_image(image_file)
+  image = _read_image(image_file, draft=draft)
   if image is None:
     return None
   image = _prep_image(image)
@@ -209,10 +243,66 @@ def prep_aquila(image_file):
   # floats on the domain [0, 1). So let's take that into account.
   image = numpy.array(image)
   # image = image / 256.
-  return image.astype(numpy.uint8)
+  return image.astype(numpy.uint8, copy=False)
+
+
+def _serial_images(imagefns):
+  '''
+  Yields (filename, preprocessed image) for each image, decoding them one
+  at a time.
+  '''
+  for imagefn in imagefns:
+    yield imagefn, prep_aquila(imagefn)
 
 
-def do_inference(hostport, concurrency, listfile):
+def _pipelined_images(imagefns, num_threads, queue_size):
+  '''
+  Yields (filename, preprocessed image) for each image, in the order that
+  they are ready. The images are decoded at reduced resolution by a pool
+  of threads. At most queue_size decoded images are buffered, so that
+  decoding doesn't run too far ahead of the inference requests.
+
+  Args:
+    imagefns: The list of fully-qualified image paths.
+    num_threads: The number of decoding threads.
+    queue_size: The maximum number of decoded images to buffer.
+  '''
+  filename_queue = Queue.Queue()
+  for imagefn in imagefns:
+    filename_queue.put(imagefn)
+  image_queue = Queue.Queue(maxsize=queue_size)
+
+  def decode():
+    while True:
+      try:
+        imagefn = filename_queue.get_nowait()
+      except Queue.Empty:
+        break
+      try:
+        image_array = prep_aquila(imagefn, draft=True)
+      except Exception, e:
+        warn('Problem preprocessing %s, error: %s' % (imagefn, e))
+        image_array = None
+      image_queue.put((imagefn, image_array))
+    # signal that this thread is done
+    image_queue.put(None)
+
+  for _ in range(num_threads):
+    thread = threading.Thread(target=decode)
+    thread.daemon = True
+    thread.start()
+
+  finished = 0
+  while finished < num_threads:
+    item = image_queue.get()
+    if item is None:
+      finished += 1
+      continue
+    yield item
+
+
+def do_inference(hostport, concurrency, listfile, save_arrays=True,
+                 bulk=False, decode_threads=4, queue_size=64):
   '''
   Performs inference over multiple images given a list of images
   as a text file, with one image per line. The image path cannot
@@ -224,6 +314,13 @@ def do_inference(hostport, concurrency, listfile):
     concurrency: Maximum number of concurrent requests.
     listfile: The path to a text file containing the fully-qualified
       path to a single image per line.
+    save_arrays: If True, each preprocessed image is saved next to the
+      image as a .npy file.
+    bulk: If True, images are decoded at reduced resolution in a pool of
+      threads that feeds the requests, rather than serially.
+    decode_threads: The number of decoding threads in bulk mode.
+    queue_size: The maximum number of decoded images waiting to be sent
+      in bulk mode.
 
   Returns:
     None.
@@ -259,17 +356,20 @@ def do_inference(hostport, concurrency, listfile):
       result_status['active'] -= 1
       cv.notify()
 
-  for imagefn in imagefns:
-    image_array = prep_aquila(imagefn)
-    np.save(imagefn + 'arr', image_array)
+  if bulk:
+    images = _pipelined_images(imagefns, decode_threads, queue_size)
+  else:
+    images = _serial_images(imagefns)
+  for imagefn, image_array in images:
     if image_array is None:
       num_images -= 1
       continue
+    if save_arrays:
+      np.save(imagefn + 'arr', image_array)
     request = aquila_inference_pb2.AquilaRequest()
-    # this is not as efficient as i feel like it could be,
-    # since you have to flatten the array then turn it into
-    # a list before you extend the request image_data field.
-    request.image_data = image_array.flatten().tostring()
+    # image_array is C contiguous, so tostring copies its buffer
+    # straight into the bytes without flattening it first.
+    request.image_data = image_array.tostring()
     with cv:
       while result_status['active'] == concurrency:
         cv.wait()
@@ -299,7 +399,11 @@ def main(_):
   elif FLAGS.image_list_file:
     inference_results = do_inference(FLAGS.server,
                                      FLAGS.concurrency,
-                                     FLAGS.image_list_file)
+                                     FLAGS.image_list_file,
+                                     save_arrays=FLAGS.save_arrays,
+                                     bulk=FLAGS.bulk,
+                                     decode_threads=FLAGS.decode_threads,
+                                     queue_size=FLAGS.queue_size)
     with open('/tmp/aquila_2_test', 'w') as f:
       for filename, valence in inference_results:
         print filename#, 'Inference:', valence
@@ -3,7 +3,9 @@
 // responds with float values that denote the inferred valence of the image.
 
 #include <stddef.h>
+#include <string.h>
 #include <algorithm>
+#include <map>
 #include <memory>
 #include <string>
 #include <vector>
@@ -15,6 +17,7 @@
 #include "grpc++/server.h"
 #include "grpc++/server_builder.h"
 #include "grpc++/server_context.h"
+#include "grpc++/support/async_stream.h"
 #include "grpc++/support/async_unary_call.h"
 #include "grpc++/support/status.h"
 #include "grpc++/support/status_code_enum.h"
@@ -27,6 +30,7 @@
 #include "tensorflow/core/lib/strings/strcat.h"
 #include "tensorflow/core/platform/env.h"
 #include "tensorflow/core/platform/init_main.h"
+#include "tensorflow/core/platform/mutex.h"
 #include "tensorflow/core/platform/types.h"
 #include "tensorflow/core/util/command_line_flags.h"
 #include "tensorflow_serving/batching/basic_batch_scheduler.h"
@@ -44,12 +48,15 @@
 
 using grpc::InsecureServerCredentials;
 using grpc::Server;
+using grpc::ServerAsyncReaderWriter;
 using grpc::ServerAsyncResponseWriter;
 using grpc::ServerBuilder;
 using grpc::ServerContext;
 using grpc::ServerCompletionQueue;
 using grpc::Status;
 using grpc::StatusCode;
+using tensorflow::serving::AquilaBatchRequest;
+using tensorflow::serving::AquilaBatchResponse;
 using tensorflow::serving::AquilaRequest;
 using tensorflow::serving::AquilaResponse;
 using tensorflow::serving::AquilaService;
@@ -63,17 +70,53 @@ const int kNumChannels = 3;
 const int kImageDataSize = kImageSize * kImageSize * kNumChannels;
 const int kNumAbstFeats = 1024;  // I'm not sure if this is actually necessary, but w/e
 const string model_version = "20160713-aquilav2"; // the model version that will be used
+// The maximum number of images read from a RegressStream call whose
+// responses haven't been written yet.
+const int kMaxStreamInFlight = 64;
+// Descriptor of the packed features returned when a request sets
+// packed_features. The server only runs on little endian hosts, so the
+// floats are copied out of the output tensor as they are.
+const char kPackedFeaturesDtype[] = "<f4";
 
 class AquilaServiceImpl;
 
+// Something that is used as a tag on the completion queue.
+class CompletionTag {
+ public:
+  virtual ~CompletionTag() = default;
+
+  // Called when the operation tagged with this object completes. `ok`
+  // is the status that the completion queue returned.
+  virtual void Proceed(bool ok) = 0;
+};
+
+// Base class for the state of a request, so that the completion queue can
+// drive any type of call.
+class CallDataBase : public CompletionTag {
+ public:
+  // Records the output for image number `image` of the request, which is
+  // row `row` of `batched_valence`.
+  virtual void SetValence(int image, const Tensor& batched_valence,
+                          int row) = 0;
+
+  // Called once for each Task created from the request when it is done.
+  // `first_image` is the index of the Task's first image in the request.
+  virtual void TaskDone(int first_image, Status status) = 0;
+};
+
 // Class encompassing the state and logic needed to serve a request.
-class CallData {
+class CallData : public CallDataBase {
  public:
   CallData(AquilaServiceImpl* service_impl,
            AquilaService::AsyncService* service,
            ServerCompletionQueue* cq);
 
-  void Proceed();
+  void Proceed(bool ok) override;
+
+  void SetValence(int image, const Tensor& batched_valence,
+                  int row) override;
+
+  void TaskDone(int first_image, Status status) override { Finish(status); }
 
   void Finish(Status status);
 
@@ -108,15 +151,143 @@ class CallData {
   CallStatus status_;  // The current serving state.
 };
 
-// A Task holds all of the information for a single inference request.
-struct Task : public tensorflow::serving::BatchTask {
-  ~Task() override = default;
-  size_t size() const override { return 1; }
+// State and logic needed to serve a RegressBatch request. The images in
+// the request may be split across several Tasks, which can complete in
+// any order on different batch threads.
+class BatchCallData : public CallDataBase {
+ public:
+  BatchCallData(AquilaServiceImpl* service_impl,
+                AquilaService::AsyncService* service,
+                ServerCompletionQueue* cq);
+
+  void Proceed(bool ok) override;
+
+  void SetValence(int image, const Tensor& batched_valence,
+                  int row) override;
+
+  void TaskDone(int first_image, Status status) override;
 
-  Task(CallData* calldata_arg)
-      : calldata(calldata_arg) {}
+  // Sets the number of Tasks that must call TaskDone before the response
+  // is sent.
+  void set_pending_tasks(int pending_tasks) { pending_tasks_ = pending_tasks; }
 
-  CallData* calldata;
+  void Finish(Status status);
+
+  const AquilaBatchRequest& request() { return request_; }
+
+ private:
+  AquilaServiceImpl* service_impl_;
+  AquilaService::AsyncService* service_;
+  ServerCompletionQueue* cq_;
+  ServerContext ctx_;
+
+  AquilaBatchRequest request_;
+  AquilaBatchResponse response_;
+
+  ServerAsyncResponseWriter<AquilaBatchResponse> responder_;
+
+  // Guards the response and the task bookkeeping.
+  tensorflow::mutex mu_;
+  int pending_tasks_ = 0;
+  Status status_of_tasks_;
+
+  enum CallStatus { CREATE, PROCESS, FINISH };
+  CallStatus status_;
+};
+
+// State and logic needed to serve a RegressStream call. Each image read
+// from the stream is scheduled as its own Task, and the responses are
+// written back in the order the images were read. At most
+// kMaxStreamInFlight images are read ahead of the responses that have
+// been written, so that a slow reader holds back a fast writer.
+class StreamCallData : public CallDataBase {
+ public:
+  StreamCallData(AquilaServiceImpl* service_impl,
+                 AquilaService::AsyncService* service,
+                 ServerCompletionQueue* cq);
+
+  // Handles the start of a new call.
+  void Proceed(bool ok) override;
+
+  void SetValence(int image, const Tensor& batched_valence,
+                  int row) override;
+
+  void TaskDone(int first_image, Status status) override;
+
+ private:
+  // Tag for one kind of event on the stream.
+  class Event : public CompletionTag {
+   public:
+    Event(StreamCallData* calldata, void (StreamCallData::*handler)(bool))
+        : calldata_(calldata), handler_(handler) {}
+    void Proceed(bool ok) override { (calldata_->*handler_)(ok); }
+
+   private:
+    StreamCallData* calldata_;
+    void (StreamCallData::*handler_)(bool);
+  };
+
+  void OnRead(bool ok);
+  void OnWrite(bool ok);
+  void OnFinish(bool ok);
+
+  // The following must be called with mu_ held.
+  void StartReadLocked();
+  void MaybeWriteLocked();
+  void MaybeFinishLocked();
+  void FailLocked(Status status);
+
+  AquilaServiceImpl* service_impl_;
+  AquilaService::AsyncService* service_;
+  ServerCompletionQueue* cq_;
+  ServerContext ctx_;
+
+  ServerAsyncReaderWriter<AquilaResponse, AquilaRequest> stream_;
+
+  Event read_event_;
+  Event write_event_;
+  Event finish_event_;
+
+  tensorflow::mutex mu_;
+  // The request being read.
+  std::unique_ptr<AquilaRequest> next_request_;
+  // Requests that have been read, but whose response hasn't been written,
+  // by sequence number. The Tasks point into them.
+  std::map<int, std::unique_ptr<AquilaRequest>> requests_;
+  // Responses that are ready to be written, by sequence number.
+  std::map<int, std::unique_ptr<AquilaResponse>> responses_;
+  // The response being written.
+  std::unique_ptr<AquilaResponse> write_response_;
+  int next_read_seq_ = 0;
+  int next_write_seq_ = 0;
+  int tasks_in_flight_ = 0;
+  bool reading_ = false;
+  bool writing_ = false;
+  bool reads_done_ = false;
+  bool finishing_ = false;
+  Status error_;
+
+  enum CallStatus { CREATE, PROCESS };
+  CallStatus status_;
+};
+
+// A Task holds all of the information for some number of consecutive
+// images from a single inference request.
+struct Task : public tensorflow::serving::BatchTask {
+  ~Task() override = default;
+  size_t size() const override { return num_images; }
+
+  Task(CallDataBase* calldata_arg, const char* image_data_arg,
+       int first_image_arg, int num_images_arg)
+      : calldata(calldata_arg), image_data(image_data_arg),
+        first_image(first_image_arg), num_images(num_images_arg) {}
+
+  CallDataBase* calldata;
+  // The data for the task's images, owned by the request.
+  const char* image_data;
+  // The index of the task's first image in the request.
+  int first_image;
+  int num_images;
 };
 
 
@@ -127,6 +298,13 @@ class AquilaServiceImpl final {
 
   void Regress(CallData* call_data);
 
+  void RegressBatch(BatchCallData* call_data);
+
+  // Submits num_images consecutive images from a request to the batch
+  // scheduler as a single Task.
+  tensorflow::Status Schedule(CallDataBase* calldata, const char* image_data,
+                              int first_image, int num_images);
+
   // Produces regressions for a batch of requests and associated responses.
   void DoRegressInBatch(
       std::unique_ptr<tensorflow::serving::Batch<Task>> batch);
@@ -138,8 +316,38 @@ class AquilaServiceImpl final {
   // A scheduler for batching multiple request calls into single calls to
   // Session->Run().
   std::unique_ptr<tensorflow::serving::BatchScheduler<Task>> batch_scheduler_;
+  // The largest Task that the scheduler accepts.
+  int max_batch_size_;
 };
 
+// Copies row `row` of `batched_valence` as packed floats to `dst`.
+void CopyPackedRow(const Tensor& batched_valence, int row, char* dst) {
+  const int num_features = batched_valence.dim_size(1);
+  const float* src = batched_valence.matrix<float>().data() +
+      row * num_features;
+  memcpy(dst, src, num_features * sizeof(float));
+}
+
+// Fills the outputs of `response` from row `row` of `batched_valence`,
+// either as packed features or as the repeated valence.
+void FillResponse(const Tensor& batched_valence, int row, bool packed,
+                  AquilaResponse* response) {
+  const int num_features = batched_valence.dim_size(1);
+  if (packed) {
+    string* features = response->mutable_features();
+    features->resize(num_features * sizeof(float));
+    CopyPackedRow(batched_valence, row, &(*features)[0]);
+    response->set_features_dtype(kPackedFeaturesDtype);
+    response->add_features_shape(num_features);
+  } else {
+    auto valence = response->mutable_valence();
+    for (int j = 0; j < num_features; ++j){
+      valence->Add(batched_valence.matrix<float>()(row, j));
+    }
+  }
+  response->set_model_version(model_version);
+}
+
 // Take in the "service" instance (in this case representing an asynchronous
 // server) and the completion queue "cq" used for asynchronous communication
 // with the gRPC runtime.
@@ -149,10 +357,11 @@ CallData::CallData(AquilaServiceImpl* service_impl,
     : service_impl_(service_impl),
       service_(service), cq_(cq), responder_(&ctx_), status_(CREATE) {
   // Invoke the serving logic right away.
-  Proceed();
+  Proceed(true);
 }
 
-void CallData::Proceed() {
+void CallData::Proceed(bool ok) {
+  GPR_ASSERT(ok);
   if (status_ == CREATE) {
     // As part of the initial CREATE state, we *request* that the system
     // start processing Regression requests. In this request, "this" acts are
@@ -176,11 +385,242 @@ void CallData::Proceed() {
   }
 }
 
+void CallData::SetValence(int image, const Tensor& batched_valence,
+                          int row) {
+  FillResponse(batched_valence, row, request_.packed_features(), &response_);
+}
+
 void CallData::Finish(Status status) {
   status_ = FINISH;
   responder_.Finish(response_, status, this);
 }
 
+BatchCallData::BatchCallData(AquilaServiceImpl* service_impl,
+                             AquilaService::AsyncService* service,
+                             ServerCompletionQueue* cq)
+    : service_impl_(service_impl),
+      service_(service), cq_(cq), responder_(&ctx_), status_(CREATE) {
+  Proceed(true);
+}
+
+void BatchCallData::Proceed(bool ok) {
+  GPR_ASSERT(ok);
+  if (status_ == CREATE) {
+    service_->RequestRegressBatch(&ctx_, &request_, &responder_, cq_, cq_,
+                                  this);
+    status_ = PROCESS;
+  } else if (status_ == PROCESS) {
+    new BatchCallData(service_impl_, service_, cq_);
+    service_impl_->RegressBatch(this);
+  } else {
+    GPR_ASSERT(status_ == FINISH);
+    delete this;
+  }
+}
+
+void BatchCallData::SetValence(int image, const Tensor& batched_valence,
+                               int row) {
+  const int num_features = batched_valence.dim_size(1);
+  tensorflow::mutex_lock l(mu_);
+  if (request_.packed_features()) {
+    if (response_.num_features() == 0) {
+      response_.set_num_features(num_features);
+      response_.mutable_features()->resize(
+          request_.num_images() * num_features * sizeof(float));
+      response_.set_features_dtype(kPackedFeaturesDtype);
+      response_.add_features_shape(request_.num_images());
+      response_.add_features_shape(num_features);
+    }
+    CopyPackedRow(batched_valence, row, &(*response_.mutable_features())[
+        image * num_features * sizeof(float)]);
+    return;
+  }
+  if (response_.num_features() == 0) {
+    response_.set_num_features(num_features);
+    response_.mutable_valence()->Resize(
+        request_.num_images() * num_features, 0.0f);
+  }
+  float* dst = response_.mutable_valence()->mutable_data() +
+      image * num_features;
+  for (int j = 0; j < num_features; ++j) {
+    dst[j] = batched_valence.matrix<float>()(row, j);
+  }
+}
+
+void BatchCallData::TaskDone(int first_image, Status status) {
+  {
+    tensorflow::mutex_lock l(mu_);
+    if (!status.ok() && status_of_tasks_.ok()) {
+      status_of_tasks_ = status;
+    }
+    if (--pending_tasks_ > 0) {
+      return;
+    }
+  }
+  Finish(status_of_tasks_);
+}
+
+void BatchCallData::Finish(Status status) {
+  status_ = FINISH;
+  if (status.ok()) {
+    response_.set_num_images(request_.num_images());
+    response_.set_model_version(model_version);
+  } else {
+    response_.Clear();
+  }
+  responder_.Finish(response_, status, this);
+}
+
+// Creates a gRPC Status from a TensorFlow Status.
+Status ToGRPCStatus(const tensorflow::Status& status) {
+  return Status(static_cast<grpc::StatusCode>(status.code()),
+                status.error_message());
+}
+
+StreamCallData::StreamCallData(AquilaServiceImpl* service_impl,
+                               AquilaService::AsyncService* service,
+                               ServerCompletionQueue* cq)
+    : service_impl_(service_impl), service_(service), cq_(cq),
+      stream_(&ctx_),
+      read_event_(this, &StreamCallData::OnRead),
+      write_event_(this, &StreamCallData::OnWrite),
+      finish_event_(this, &StreamCallData::OnFinish),
+      status_(CREATE) {
+  Proceed(true);
+}
+
+void StreamCallData::Proceed(bool ok) {
+  if (status_ == CREATE) {
+    service_->RequestRegressStream(&ctx_, &stream_, cq_, cq_, this);
+    status_ = PROCESS;
+  } else {
+    GPR_ASSERT(ok);
+    new StreamCallData(service_impl_, service_, cq_);
+    tensorflow::mutex_lock l(mu_);
+    StartReadLocked();
+  }
+}
+
+void StreamCallData::StartReadLocked() {
+  if (reading_ || reads_done_ || !error_.ok() ||
+      static_cast<int>(requests_.size()) >= kMaxStreamInFlight) {
+    return;
+  }
+  reading_ = true;
+  next_request_.reset(new AquilaRequest());
+  stream_.Read(next_request_.get(), &read_event_);
+}
+
+void StreamCallData::OnRead(bool ok) {
+  int seq;
+  const char* image_data;
+  {
+    tensorflow::mutex_lock l(mu_);
+    reading_ = false;
+    if (!ok) {
+      // The client is done writing, or the call was cancelled.
+      reads_done_ = true;
+      MaybeFinishLocked();
+      return;
+    }
+    if (!error_.ok()) {
+      MaybeFinishLocked();
+      return;
+    }
+    if (next_request_->image_data().size() != kImageDataSize) {
+      FailLocked(Status(StatusCode::INVALID_ARGUMENT,
+                        "image_data must be a 299 x 299 x 3 image"));
+      return;
+    }
+    seq = next_read_seq_++;
+    image_data = next_request_->image_data().data();
+    requests_[seq] = std::move(next_request_);
+    ++tasks_in_flight_;
+    StartReadLocked();
+  }
+
+  tensorflow::Status status = service_impl_->Schedule(this, image_data,
+                                                      seq, 1);
+  if (!status.ok()) {
+    TaskDone(seq, ToGRPCStatus(status));
+  }
+}
+
+void StreamCallData::SetValence(int image, const Tensor& batched_valence,
+                                int row) {
+  std::unique_ptr<AquilaResponse> response(new AquilaResponse());
+  tensorflow::mutex_lock l(mu_);
+  FillResponse(batched_valence, row, requests_[image]->packed_features(),
+               response.get());
+  responses_[image] = std::move(response);
+}
+
+void StreamCallData::TaskDone(int first_image, Status status) {
+  tensorflow::mutex_lock l(mu_);
+  --tasks_in_flight_;
+  if (!status.ok()) {
+    FailLocked(status);
+    return;
+  }
+  MaybeWriteLocked();
+}
+
+void StreamCallData::MaybeWriteLocked() {
+  if (writing_ || finishing_) {
+    return;
+  }
+  if (error_.ok()) {
+    auto it = responses_.find(next_write_seq_);
+    if (it != responses_.end()) {
+      write_response_ = std::move(it->second);
+      responses_.erase(it);
+      requests_.erase(next_write_seq_);
+      ++next_write_seq_;
+      writing_ = true;
+      stream_.Write(*write_response_, &write_event_);
+      // There's room to read another image.
+      StartReadLocked();
+      return;
+    }
+  }
+  MaybeFinishLocked();
+}
+
+void StreamCallData::OnWrite(bool ok) {
+  tensorflow::mutex_lock l(mu_);
+  writing_ = false;
+  if (!ok) {
+    FailLocked(Status(StatusCode::CANCELLED, "The stream was closed"));
+    return;
+  }
+  MaybeWriteLocked();
+}
+
+void StreamCallData::FailLocked(Status status) {
+  if (error_.ok()) {
+    error_ = status;
+    // Stop any outstanding read
+    ctx_.TryCancel();
+  }
+  MaybeFinishLocked();
+}
+
+void StreamCallData::MaybeFinishLocked() {
+  // The call can only finish once nothing else refers to it.
+  if (finishing_ || reading_ || writing_ || tasks_in_flight_ > 0) {
+    return;
+  }
+  if (error_.ok() && !(reads_done_ && next_write_seq_ == next_read_seq_)) {
+    return;
+  }
+  finishing_ = true;
+  stream_.Finish(error_, &finish_event_);
+}
+
+void StreamCallData::OnFinish(bool ok) {
+  delete this;
+}
+
 AquilaServiceImpl::AquilaServiceImpl(
     const string& servable_name,
     std::unique_ptr<tensorflow::serving::Manager> manager)
@@ -201,6 +641,7 @@ AquilaServiceImpl::AquilaServiceImpl(
   scheduler_options.num_batch_threads = 4;
   scheduler_options.max_batch_size = 22;
   scheduler_options.max_enqueued_batches = 100; // let's set it very high for now.
+  max_batch_size_ = scheduler_options.max_batch_size;
   tensorflow::serving::BatchSchedulerRetrier<Task>::Options retry_options;
   // Retain the default retry options.
   TF_CHECK_OK(tensorflow::serving::CreateRetryingBasicBatchScheduler<Task>(
@@ -211,16 +652,24 @@ AquilaServiceImpl::AquilaServiceImpl(
       &batch_scheduler_));
 }
 
-// Creates a gRPC Status from a TensorFlow Status.
-Status ToGRPCStatus(const tensorflow::Status& status) {
-  return Status(static_cast<grpc::StatusCode>(status.code()),
-                status.error_message());
+tensorflow::Status AquilaServiceImpl::Schedule(CallDataBase* calldata,
+                                               const char* image_data,
+                                               int first_image,
+                                               int num_images) {
+  std::unique_ptr<Task> task(new Task(calldata, image_data, first_image,
+                                      num_images));
+  return batch_scheduler_->Schedule(&task);
 }
 
 void AquilaServiceImpl::Regress(CallData* calldata) {
+  if (calldata->request().image_data().size() != kImageDataSize) {
+    calldata->Finish(Status(StatusCode::INVALID_ARGUMENT,
+                            "image_data must be a 299 x 299 x 3 image"));
+    return;
+  }
   // Create and submit a task to the batch scheduler.
-  std::unique_ptr<Task> task(new Task(calldata));
-  tensorflow::Status status = batch_scheduler_->Schedule(&task);
+  tensorflow::Status status = Schedule(
+      calldata, calldata->request().image_data().data(), 0, 1);
 
   if (!status.ok()) {
     calldata->Finish(ToGRPCStatus(status));
@@ -228,6 +677,35 @@ void AquilaServiceImpl::Regress(CallData* calldata) {
   }
 }
 
+void AquilaServiceImpl::RegressBatch(BatchCallData* calldata) {
+  const int num_images = calldata->request().num_images();
+  const string& image_data = calldata->request().image_data();
+  if (num_images <= 0 ||
+      image_data.size() != static_cast<size_t>(num_images) * kImageDataSize) {
+    calldata->Finish(Status(
+        StatusCode::INVALID_ARGUMENT,
+        "image_data must hold num_images 299 x 299 x 3 images"));
+    return;
+  }
+
+  // Split the request into tasks that fit in a batch. They are merged
+  // with other requests by the scheduler like any other task.
+  const int num_tasks = (num_images + max_batch_size_ - 1) / max_batch_size_;
+  calldata->set_pending_tasks(num_tasks);
+  for (int first = 0; first < num_images; first += max_batch_size_) {
+    const int count = std::min(max_batch_size_, num_images - first);
+    tensorflow::Status status = Schedule(
+        calldata, image_data.data() + first * kImageDataSize, first, count);
+    if (!status.ok()) {
+      // Fail this task and all the ones that were never scheduled.
+      for (int i = first; i < num_images; i += max_batch_size_) {
+        calldata->TaskDone(i, ToGRPCStatus(status));
+      }
+      return;
+    }
+  }
+}
+
 // Produces regressions for a batch of requests and associated responses.
 void AquilaServiceImpl::DoRegressInBatch(
     std::unique_ptr<tensorflow::serving::Batch<Task>> batch) {
@@ -235,14 +713,16 @@ void AquilaServiceImpl::DoRegressInBatch(
   if (batch->empty()) {
     return;
   }
-  const int batch_size = batch->num_tasks();
+  // The number of images in the batch, which may be more than the number
+  // of tasks.
+  const int batch_size = batch->size();
 
   // Replies to each task with the given error status.
   auto complete_with_error = [&batch](StatusCode code, const string& msg) {
     Status status(code, msg);
     for (int i = 0; i < batch->num_tasks(); i++) {
       Task* task = batch->mutable_task(i);
-      task->calldata->Finish(status);
+      task->calldata->TaskDone(task->first_image, status);
     }
   };
 
@@ -274,13 +754,12 @@ void AquilaServiceImpl::DoRegressInBatch(
   // Transform protobuf input to inference input tensor.
   tensorflow::Tensor input(tensorflow::DT_UINT8, {batch_size, kImageDataSize});
   auto dst = input.flat_outer_dims<uint8_t>().data();
-  // Assemble the batch into a tensor, copying it from the batch data to
-  // the input tensor at location dst repeatedly for each item in the batch
-  for (int i = 0; i < batch_size; ++i) {
-    std::copy_n(
-        batch->mutable_task(i)->calldata->request().image_data().begin(),
-        kImageDataSize, dst);
-    dst += kImageDataSize;
+  // Assemble the batch into a tensor, copying the images of each task in
+  // the batch to the input tensor at location dst in turn.
+  for (int i = 0; i < batch->num_tasks(); ++i) {
+    const Task& task = batch->task(i);
+    std::copy_n(task.image_data, task.num_images * kImageDataSize, dst);
+    dst += task.num_images * kImageDataSize;
   }
 
   // Run regression.
@@ -294,31 +773,32 @@ void AquilaServiceImpl::DoRegressInBatch(
   }
 
   // Transform inference output tensor to protobuf output.
-  for (int i = 0; i < batch_size; ++i) {
-    auto calldata = batch->mutable_task(i)->calldata;
-    auto valence = calldata->mutable_response()->mutable_valence();
-    for (int j = 0; j < batched_valence.dim_size(1); ++j){
-      valence->Add(batched_valence.matrix<float>()(i, j));
+  int row = 0;
+  for (int i = 0; i < batch->num_tasks(); ++i) {
+    Task* task = batch->mutable_task(i);
+    for (int j = 0; j < task->num_images; ++j) {
+      task->calldata->SetValence(task->first_image + j, batched_valence,
+                                 row++);
     }
-    calldata->mutable_response()->set_model_version(model_version);
-    calldata->Finish(Status::OK);
+    task->calldata->TaskDone(task->first_image, Status::OK);
   }
 }
 
 void HandleRpcs(AquilaServiceImpl* service_impl,
                 AquilaService::AsyncService* service,
                 ServerCompletionQueue* cq) {
-  // Spawn a new CallData `instance to serve new clients.
+  // Spawn new CallData instances to serve new clients.
   new CallData(service_impl, service, cq);
+  new BatchCallData(service_impl, service, cq);
+  new StreamCallData(service_impl, service, cq);
   void* tag;  // uniquely identifies a request.
   bool ok;
   while (true) {
     // Block waiting to read the next event from the completion queue. The
     // event is uniquely identified by its tag, which in this case is the
-    // memory address of a CallData instance.
+    // memory address of a CompletionTag instance.
     cq->Next(&tag, &ok);
-    GPR_ASSERT(ok);
-    static_cast<CallData*>(tag)->Proceed();
+    static_cast<CompletionTag*>(tag)->Proceed(ok);
   }
 }
 
@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='aquila_inference.proto',
   package='tensorflow.serving',
   syntax='proto3',
-  serialized_pb=_b('\n\x16\x61quila_inference.proto\x12\x12tensorflow.serving\"#\n\rAquilaRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\"8\n\x0e\x41quilaResponse\x12\x0f\n\x07valence\x18\x01 \x03(\x02\x12\x15\n\rmodel_version\x18\x02 \x01(\t2a\n\rAquilaService\x12P\n\x07Regress\x12!.tensorflow.serving.AquilaRequest\x1a\".tensorflow.serving.AquilaResponseb\x06proto3')
+  serialized_pb=_b('\n\x16\x61quila_inference.proto\x12\x12tensorflow.serving\"<\n\rAquilaRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\x17\n\x0fpacked_features\x18\x02 \x01(\x08\"z\n\x0e\x41quilaResponse\x12\x0f\n\x07valence\x18\x01 \x03(\x02\x12\x15\n\rmodel_version\x18\x02 \x01(\t\x12\x10\n\x08\x66\x65\x61tures\x18\x03 \x01(\x0c\x12\x16\n\x0e\x66\x65\x61tures_dtype\x18\x04 \x01(\t\x12\x16\n\x0e\x66\x65\x61tures_shape\x18\x05 \x03(\x05\"U\n\x12\x41quilaBatchRequest\x12\x12\n\nimage_data\x18\x01 \x01(\x0c\x12\x12\n\nnum_images\x18\x02 \x01(\x05\x12\x17\n\x0fpacked_features\x18\x03 \x01(\x08\"\xa9\x01\n\x13\x41quilaBatchResponse\x12\x0f\n\x07valence\x18\x01 \x03(\x02\x12\x12\n\nnum_images\x18\x02 \x01(\x05\x12\x14\n\x0cnum_features\x18\x03 \x01(\x05\x12\x15\n\rmodel_version\x18\x04 \x01(\t\x12\x10\n\x08\x66\x65\x61tures\x18\x05 \x01(\x0c\x12\x16\n\x0e\x66\x65\x61tures_dtype\x18\x06 \x01(\t\x12\x16\n\x0e\x66\x65\x61tures_shape\x18\x07 \x03(\x05\x32\x9e\x02\n\rAquilaService\x12P\n\x07Regress\x12!.tensorflow.serving.AquilaRequest\x1a\".tensorflow.serving.AquilaResponse\x12_\n\x0cRegressBatch\x12&.tensorflow.serving.AquilaBatchRequest\x1a\'.tensorflow.serving.AquilaBatchResponse\x12Z\n\rRegressStream\x12!.tensorflow.serving.AquilaRequest\x1a\".tensorflow.serving.AquilaResponse(\x01\x30\x01\x62\x06proto3')
 )
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
@@ -40,6 +40,13 @@ _AQUILAREQUEST = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='packed_features', full_name='tensorflow.serving.AquilaRequest.packed_features', index=1,
+      number=2, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -53,7 +60,7 @@ _AQUILAREQUEST = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=46,
-  serialized_end=81,
+  serialized_end=106,
 )
 
 
@@ -78,6 +85,72 @@ _AQUILARESPONSE = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='features', full_name='tensorflow.serving.AquilaResponse.features', index=2,
+      number=3, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='features_dtype', full_name='tensorflow.serving.AquilaResponse.features_dtype', index=3,
+      number=4, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='features_shape', full_name='tensorflow.serving.AquilaResponse.features_shape', index=4,
+      number=5, type=5, cpp_type=1, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=108,
+  serialized_end=230,
+)
+
+
+_AQUILABATCHREQUEST = _descriptor.Descriptor(
+  name='AquilaBatchRequest',
+  full_name='tensorflow.serving.AquilaBatchRequest',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='image_data', full_name='tensorflow.serving.AquilaBatchRequest.image_data', index=0,
+      number=1, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='num_images', full_name='tensorflow.serving.AquilaBatchRequest.num_images', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='packed_features', full_name='tensorflow.serving.AquilaBatchRequest.packed_features', index=2,
+      number=3, type=8, cpp_type=7, label=1,
+      has_default_value=False, default_value=False,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -90,12 +163,87 @@ _AQUILARESPONSE = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=83,
-  serialized_end=139,
+  serialized_start=232,
+  serialized_end=317,
+)
+
+
+_AQUILABATCHRESPONSE = _descriptor.Descriptor(
+  name='AquilaBatchResponse',
+  full_name='tensorflow.serving.AquilaBatchResponse',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='valence', full_name='tensorflow.serving.AquilaBatchResponse.valence', index=0,
+      number=1, type=2, cpp_type=6, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='num_images', full_name='tensorflow.serving.AquilaBatchResponse.num_images', index=1,
+      number=2, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='num_features', full_name='tensorflow.serving.AquilaBatchResponse.num_features', index=2,
+      number=3, type=5, cpp_type=1, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='model_version', full_name='tensorflow.serving.AquilaBatchResponse.model_version', index=3,
+      number=4, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='features', full_name='tensorflow.serving.AquilaBatchResponse.features', index=4,
+      number=5, type=12, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b(""),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='features_dtype', full_name='tensorflow.serving.AquilaBatchResponse.features_dtype', index=5,
+      number=6, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='features_shape', full_name='tensorflow.serving.AquilaBatchResponse.features_shape', index=6,
+      number=7, type=5, cpp_type=1, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=320,
+  serialized_end=489,
 )
 
 DESCRIPTOR.message_types_by_name['AquilaRequest'] = _AQUILAREQUEST
 DESCRIPTOR.message_types_by_name['AquilaResponse'] = _AQUILARESPONSE
+DESCRIPTOR.message_types_by_name['AquilaBatchRequest'] = _AQUILABATCHREQUEST
+DESCRIPTOR.message_types_by_name['AquilaBatchResponse'] = _AQUILABATCHRESPONSE
 
 AquilaRequest = _reflection.GeneratedProtocolMessageType('AquilaRequest', (_message.Message,), dict(
   DESCRIPTOR = _AQUILAREQUEST,
@@ -111,6 +259,20 @@ AquilaResponse = _reflection.GeneratedProtocolMessageType('AquilaResponse', (_me
   ))
 _sym_db.RegisterMessage(AquilaResponse)
 
+AquilaBatchRequest = _reflection.GeneratedProtocolMessageType('AquilaBatchRequest', (_message.Message,), dict(
+  DESCRIPTOR = _AQUILABATCHREQUEST,
+  __module__ = 'aquila_inference_pb2'
+  # @@protoc_insertion_point(class_scope:tensorflow.serving.AquilaBatchRequest)
+  ))
+_sym_db.RegisterMessage(AquilaBatchRequest)
+
+AquilaBatchResponse = _reflection.GeneratedProtocolMessageType('AquilaBatchResponse', (_message.Message,), dict(
+  DESCRIPTOR = _AQUILABATCHRESPONSE,
+  __module__ = 'aquila_inference_pb2'
+  # @@protoc_insertion_point(class_scope:tensorflow.serving.AquilaBatchResponse)
+  ))
+_sym_db.RegisterMessage(AquilaBatchResponse)
+
 
 import abc
 import six
@@ -123,39 +285,68 @@ class BetaAquilaServiceServicer(object):
   """<fill me in later!>"""
   def Regress(self, request, context):
     context.code(beta_interfaces.StatusCode.UNIMPLEMENTED)
+  def RegressBatch(self, request, context):
+    context.code(beta_interfaces.StatusCode.UNIMPLEMENTED)
+  def RegressStream(self, request_iterator, context):
+    context.code(beta_interfaces.StatusCode.UNIMPLEMENTED)
 
 class BetaAquilaServiceStub(object):
   """The interface to which stubs will conform."""
   def Regress(self, request, timeout):
     raise NotImplementedError()
   Regress.future = None
+  def RegressBatch(self, request, timeout):
+    raise NotImplementedError()
+  RegressBatch.future = None
+  def RegressStream(self, request_iterator, timeout):
+    raise NotImplementedError()
 
 def beta_create_AquilaService_server(servicer, pool=None, pool_size=None, default_timeout=None, maximum_timeout=None):
+  import aquila_inference_pb2
+  import aquila_inference_pb2
+  import aquila_inference_pb2
+  import aquila_inference_pb2
   import aquila_inference_pb2
   import aquila_inference_pb2
   request_deserializers = {
     ('tensorflow.serving.AquilaService', 'Regress'): aquila_inference_pb2.AquilaRequest.FromString,
+    ('tensorflow.serving.AquilaService', 'RegressBatch'): aquila_inference_pb2.AquilaBatchRequest.FromString,
+    ('tensorflow.serving.AquilaService', 'RegressStream'): aquila_inference_pb2.AquilaRequest.FromString,
   }
   response_serializers = {
     ('tensorflow.serving.AquilaService', 'Regress'): aquila_inference_pb2.AquilaResponse.SerializeToString,
+    ('tensorflow.serving.AquilaService', 'RegressBatch'): aquila_inference_pb2.AquilaBatchResponse.SerializeToString,
+    ('tensorflow.serving.AquilaService', 'RegressStream'): aquila_inference_pb2.AquilaResponse.SerializeToString,
   }
   method_implementations = {
     ('tensorflow.serving.AquilaService', 'Regress'): face_utilities.unary_unary_inline(servicer.Regress),
+    ('tensorflow.serving.AquilaService', 'RegressBatch'): face_utilities.unary_unary_inline(servicer.RegressBatch),
+    ('tensorflow.serving.AquilaService', 'RegressStream'): face_utilities.stream_stream_inline(servicer.RegressStream),
   }
   server_options = beta_implementations.server_options(request_deserializers=request_deserializers, response_serializers=response_serializers, thread_pool=pool, thread_pool_size=pool_size, default_timeout=default_timeout, maximum_timeout=maximum_timeout)
   return beta_implementations.server(method_implementations, options=server_options)
 
 def beta_create_AquilaService_stub(channel, host=None, metadata_transformer=None, pool=None, pool_size=None):
+  import aquila_inference_pb2
+  import aquila_inference_pb2
+  import aquila_inference_pb2
+  import aquila_inference_pb2
   import aquila_inference_pb2
   import aquila_inference_pb2
   request_serializers = {
     ('tensorflow.serving.AquilaService', 'Regress'): aquila_inference_pb2.AquilaRequest.SerializeToString,
+    ('tensorflow.serving.AquilaService', 'RegressBatch'): aquila_inference_pb2.AquilaBatchRequest.SerializeToString,
+    ('tensorflow.serving.AquilaService', 'RegressStream'): aquila_inference_pb2.AquilaRequest.SerializeToString,
   }
   response_deserializers = {
     ('tensorflow.serving.AquilaService', 'Regress'): aquila_inference_pb2.AquilaResponse.FromString,
+    ('tensorflow.serving.AquilaService', 'RegressBatch'): aquila_inference_pb2.AquilaBatchResponse.FromString,
+    ('tensorflow.serving.AquilaService', 'RegressStream'): aquila_inference_pb2.AquilaResponse.FromString,
   }
   cardinalities = {
     'Regress': cardinality.Cardinality.UNARY_UNARY,
+    'RegressBatch': cardinality.Cardinality.UNARY_UNARY,
+    'RegressStream': cardinality.Cardinality.STREAM_STREAM,
   }
   stub_options = beta_implementations.stub_options(host=host, metadata_transformer=metadata_transformer, request_serializers=request_serializers, response_deserializers=response_deserializers, thread_pool=pool, thread_pool_size=pool_size)
   return beta_implementations.dynamic_stub(channel, 'tensorflow.serving.AquilaService', cardinalities, options=stub_options)
@@ -0,0 +1,76 @@
+'''
+Benchmarks preprocessing frames for Aquila.
+
+The "before" path is the per frame PIL path that the client used to take,
+Image.fromarray(frame[:, :, ::-1]) and a padded canvas built as a float
+array. The "after" path is prep_batch. Both must give the same pixels.
+
+To run it:
+python benchmark_prep.py --frames 14 --size 1920x1080
+
+Copyright: 2016 Neon Labs
+'''
+import argparse
+import client
+import numpy as np
+from PIL import Image
+import time
+
+def _pad_before(img, asp=16./9):
+    ow, oh = img.size
+    oasp = float(ow) / oh
+    if asp > oasp:
+        nw = int(oh * asp)
+        box = ((nw - ow) / 2, 0)
+        newsize = (nw, oh)
+    elif asp < oasp:
+        nh = int(ow / asp)
+        box = (0, (nh - oh) / 2)
+        newsize = (ow, nh)
+    else:
+        return img
+    nimg = np.zeros((newsize[1], newsize[0], 3)).astype(np.uint8)
+    nimg += client.MEAN_CHANNEL_VALS
+    nimg = Image.fromarray(nimg)
+    nimg.paste(img, box=box)
+    return nimg
+
+def prep_before(frames):
+    out = np.empty((len(frames), client._PREPPED_SIZE), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        img = _pad_before(Image.fromarray(frame[:, :, ::-1]))
+        out[i] = np.array(client._resize_to(img, w=299, h=299)).reshape(-1)
+    return out
+
+def prep_after(frames):
+    return client.prep_batch(frames)
+
+def _bench(name, func, frames, repeats):
+    start = time.time()
+    for i in range(repeats):
+        func(frames)
+    elapsed = time.time() - start
+    print '%-8s %8.2f ms/frame' % (name,
+                                   1000. * elapsed / (repeats * len(frames)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=14,
+                        help='Number of frames in a batch')
+    parser.add_argument('--size', default='1920x1080',
+                        help='Size of the frames as WxH')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Number of times to prep the batch')
+    args = parser.parse_args()
+
+    w, h = [int(x) for x in args.size.split('x')]
+    frames = np.random.RandomState(0).randint(
+        0, 256, (args.frames, h, w, 3)).astype(np.uint8)
+
+    assert (prep_before(frames) == prep_after(frames)).all()
+
+    _bench('before', prep_before, frames, args.repeats)
+    _bench('after', prep_after, frames, args.repeats)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+'''
+Benchmarks building the image_data of Aquila requests.
+
+For each way of building the request, this reports the time per image and
+the number of bytes of the prepped pixels that are copied on the way from
+the preprocessing output into the request. Copies are counted step by
+step: a step copies if its output doesn't share memory with its input.
+
+The "before" paths are the ones the client used to take,
+np.array(img).astype(np.uint8).flatten().tostring() for single images and
+a freshly allocated, scattered into buffer for batches.
+
+To run it:
+python benchmark_requests.py --images 56 --size 1280x720 [--mixed | --interleaved]
+
+Copyright: 2016 Neon Labs
+'''
+import aquila_inference_pb2
+import argparse
+import client
+import numpy as np
+import time
+
+def _copied(src, dst):
+    '''Returns the number of bytes copied by a step from src to dst.'''
+    if isinstance(dst, np.ndarray) and isinstance(src, np.ndarray):
+        return 0 if np.may_share_memory(src, dst) else dst.nbytes
+    if isinstance(dst, np.ndarray):
+        return dst.nbytes
+    return len(dst)
+
+def _run_steps(value, steps):
+    '''Runs value through the steps.
+
+    Returns: (final value, bytes copied)
+    '''
+    copied = 0
+    for step in steps:
+        out = step(value)
+        copied += _copied(value, out)
+        value = out
+    return value, copied
+
+# Steps from the prepped PIL image to the request bytes
+_SINGLE_BEFORE = [np.array,
+                  lambda x: x.astype(np.uint8),
+                  lambda x: x.flatten(),
+                  lambda x: x.tostring()]
+_SINGLE_AFTER = [lambda x: x.tobytes()]
+
+def single_before(image):
+    img = client._aquila_prep_image(image)
+    return _run_steps(img, _SINGLE_BEFORE)
+
+def single_after(image):
+    img = client._aquila_prep_image(image)
+    return _run_steps(img, _SINGLE_AFTER)
+
+def _prep_rows(images, out):
+    '''Preps the images into the rows of out the way client.prep_batch
+    does.
+
+    Returns: bytes copied
+    '''
+    rows = out.view()
+    rows.shape = (len(images), 299, 299, 3)
+    copied = 0
+    for i, image in enumerate(images):
+        def _to_row(x, row=rows[i]):
+            row[...] = x
+            return row
+        img = client._aquila_prep_image(image)
+        copied += _run_steps(img, [np.asarray, _to_row])[1]
+    return copied
+
+def batch_before(images):
+    # Mirrors the old _prep_batch_data, which prepped each size into new
+    # arrays and scattered them into a new output buffer.
+    out = np.empty((len(images), client._PREPPED_SIZE), dtype=np.uint8)
+    copied = 0
+    shapes = set(image.shape for image in images)
+    for shape in shapes:
+        idx = [i for i, image in enumerate(images) if image.shape == shape]
+        prepped = np.empty((len(idx), client._PREPPED_SIZE), dtype=np.uint8)
+        copied += _prep_rows([images[i] for i in idx], prepped)
+        if len(shapes) == 1:
+            out = prepped
+        else:
+            out[idx] = prepped
+            copied += prepped.nbytes
+    data, n = _run_steps(out, [lambda x: x.tostring()])
+    return data, copied + n
+
+def batch_after(images, pool=client.RequestBufferPool()):
+    # Mirrors _prep_batch_data, which preps each image straight into its
+    # row of a pooled buffer and turns the buffer into bytes once.
+    with pool.buffer(len(images)) as out:
+        copied = _prep_rows(images, out)
+        data, n = _run_steps(out, [lambda x: x.tostring()])
+    return data, copied + n
+
+def _bench(name, func, batches, nimages):
+    copied = 0
+    start = time.time()
+    for batch in batches:
+        data, n = func(batch)
+        copied += n
+        request = aquila_inference_pb2.AquilaRequest()
+        request.image_data = data
+    elapsed = time.time() - start
+    print '%-14s %8.2f ms/image %12d bytes copied/image' % (
+        name, 1000. * elapsed / nimages, copied / nimages)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--images', type=int, default=56,
+                        help='Number of images to prep')
+    parser.add_argument('--size', default='1280x720',
+                        help='Size of the images as WxH')
+    parser.add_argument('--batch_size', type=int,
+                        default=client._MAX_BATCH_IMAGES,
+                        help='Images per batch request')
+    parser.add_argument('--mixed', action='store_true',
+                        help='Use two image sizes, in runs within each batch')
+    parser.add_argument('--interleaved', action='store_true',
+                        help='Alternate between two image sizes')
+    args = parser.parse_args()
+
+    w, h = [int(x) for x in args.size.split('x')]
+    rs = np.random.RandomState(0)
+    images = []
+    for i in range(args.images):
+        if ((args.mixed and i % args.batch_size >= args.batch_size // 2) or
+            (args.interleaved and i % 2)):
+            shape = (w // 2, h // 2, 3)
+        else:
+            shape = (h, w, 3)
+        images.append(rs.randint(0, 256, shape).astype(np.uint8))
+    batches = [images[i:i + args.batch_size]
+               for i in range(0, len(images), args.batch_size)]
+
+    # Both ways of building a request must send the same bytes
+    assert single_before(images[0])[0] == single_after(images[0])[0]
+    assert batch_before(batches[0])[0] == batch_after(batches[0])[0]
+    assert batch_after(batches[0])[0] == client._prep_batch_data(batches[0])
+
+    _bench('single before', single_before, images, len(images))
+    _bench('single after', single_after, images, len(images))
+    _bench('batch before', batch_before, batches, len(images))
+    _bench('batch after', batch_after, batches, len(images))
+
+if __name__ == '__main__':
+    main()
@@ -11,20 +11,28 @@ Author: Nick Dufour
 '''
 import aquila_inference_pb2 
 import atexit
+import collections
 import concurrent.futures
+import contextlib
 import datetime
 from grpc.beta import implementations
 from grpc.beta.interfaces import ChannelConnectivity
 import hashlib
+import itertools
+import json
 import logging
+import multiprocessing
 import numpy as np
 import pandas
 from PIL import Image
 import os
 import random
+import shutil
 import time
 import tempfile
 import threading
+import tornado.concurrent
+import tornado.ioloop
 import tornado.locks
 import tornado.gen
 import utils.obj
@@ -42,6 +50,9 @@ MEAN_CHANNEL_VALS = np.array(MEAN_CHANNEL_VALS).round().astype(np.uint8)
 # Valid demographic categories
 VALID_GENDER = ['M', 'F', None]
 VALID_AGE_GROUP = ['18-19', '20-29', '30-39', '40-49', '50+', None]
+# The (gender, age) demographics, in the order of the columns returned by
+# DemographicSignatures.get_scores_for_all_demos_batch
+DEMOGRAPHICS = list(itertools.product(VALID_GENDER, VALID_AGE_GROUP))
 
 def _resize_to(img, w=None, h=None):
   '''
@@ -112,14 +123,12 @@ def _pad_to_asp(img, asp):
     newsize = (ow, nh)
   else:
     return img
-  nimg = np.zeros((newsize[1], newsize[0], 3)).astype(np.uint8)
-  nimg += MEAN_CHANNEL_VALS
-  nimg = Image.fromarray(nimg)
+  nimg = Image.new('RGB', newsize, tuple(MEAN_CHANNEL_VALS.reshape(-1)))
   nimg.paste(img, box=(left, upper))
   return nimg
 
 
-def _aquila_prep(image):
+def _aquila_prep_image(image):
     '''
     Preprocesses an image so that it is appropriate
     for input into Aquila. Aquila was trained on
@@ -128,45 +137,752 @@ def _aquila_prep(image):
     this here. For now, we assume the image provided has
     been obtained from OpenCV (and so is BGR) and will use
     PIL to prep the image.
+
+    Returns: The prepped RGB PIL image
     '''
-    img = Image.fromarray(image[:,:,::-1])
+    # PIL swaps the channels as it reads the buffer, which is much faster
+    # than having it copy a reversed numpy view.
+    h, w = image.shape[:2]
+    img = Image.frombuffer('RGB', (w, h), np.ascontiguousarray(image),
+                           'raw', 'BGR', 0, 1)
     img = _pad_to_asp(img, 16./9)
     # resize the image to 299 x 299
-    img = _resize_to(img, w=299, h=299)
-    return np.array(img).astype(np.uint8)
+    return _resize_to(img, w=299, h=299)
+
+def _aquila_prep(image):
+    '''Returns the prepped image from _aquila_prep_image as a 299 x 299 x 3
+    uint8 array.'''
+    return np.array(_aquila_prep_image(image))
+
+# Size of a preprocessed image in bytes
+_PREPPED_SIZE = 299 * 299 * 3
+
+def prep_batch(frames, out=None):
+    '''
+    Preprocesses a batch of images for input into Aquila.
+
+    The frames are prepped one at a time with _aquila_prep_image on
+    purpose. A vectorized numpy resize has to work in float64 to match
+    PIL's fixed point weights exactly, and just converting a 1080p frame
+    to float64 takes longer than PIL's whole resize. Each frame is
+    written straight into its row of a single contiguous buffer that is
+    ready to be sent to the server, so the memory used doesn't grow with
+    the batch.
+
+    Inputs:
+    frames - A list of, or N x H x W x 3 array of, uint8 images obtained
+             from OpenCV (and so BGR). The sizes may differ.
+    out - Optional C contiguous N x (299*299*3) uint8 array to fill.
+
+    Returns: The N x (299*299*3) uint8 array, where row i is
+             _aquila_prep(frames[i]).flatten()
+    '''
+    if isinstance(frames, np.ndarray) and frames.ndim == 3:
+        frames = frames[np.newaxis]
+    for frame in frames:
+        if frame.ndim != 3 or frame.shape[2] != 3:
+            raise ValueError('Expected H x W x 3 frames, got shape %s' %
+                             (frame.shape,))
+    if out is None:
+        out = np.empty((len(frames), _PREPPED_SIZE), dtype=np.uint8)
+    # A view of the rows as images. Setting the shape raises instead of
+    # silently copying if out isn't contiguous.
+    rows = out.view()
+    rows.shape = (len(frames), 299, 299, 3)
+    for i, frame in enumerate(frames):
+        # PIL keeps RGB pixels 4 bytes wide, so numpy reads them out through
+        # its packed export and copies them into the row.
+        rows[i] = _aquila_prep_image(frame)
+    return out
+
+def _prep_request_data(image):
+    '''Returns the preprocessed image as the bytes to send to Aquila.
+
+    The bytes come straight out of PIL's buffer, which is the only copy
+    of the pixels that is made.
+    '''
+    return _aquila_prep_image(image).tobytes()
+
+# gRPC limits messages to 4MB by default, so that is as many images as
+# can go in one AquilaBatchRequest.
+_MAX_BATCH_IMAGES = 14
+
+class RequestBufferPool(object):
+    '''A pool of reusable buffers to preprocess images into.
+
+    Each buffer holds up to max_images prepped images back to back, which
+    is the layout of AquilaBatchRequest.image_data, so a block of images
+    only has to be copied once, when it is turned into the bytes for the
+    request. Reusing the buffers avoids allocating and faulting in a few
+    MB for every request.
+    '''
+    def __init__(self, max_images=_MAX_BATCH_IMAGES, max_free=4):
+        '''
+        max_images - Number of images that each buffer holds.
+        max_free - Maximum number of idle buffers to keep around.
+        '''
+        self.max_images = max_images
+        self.max_free = max_free
+        self._lock = threading.Lock()
+        self._free = []
+
+    @contextlib.contextmanager
+    def buffer(self, n):
+        '''Context manager that lends out a buffer.
+
+        Yields: A C contiguous n x (299*299*3) uint8 array. It must not be
+                used after the block exits.
+        '''
+        if n > self.max_images:
+            # Too big to pool
+            yield np.empty((n, _PREPPED_SIZE), dtype=np.uint8)
+            return
+        with self._lock:
+            buf = self._free.pop() if self._free else None
+        if buf is None:
+            buf = np.empty((self.max_images, _PREPPED_SIZE), dtype=np.uint8)
+        try:
+            yield buf[:n]
+        finally:
+            with self._lock:
+                if len(self._free) < self.max_free:
+                    self._free.append(buf)
+
+_request_buffers = RequestBufferPool()
+
+def _prep_batch_data(images, pool=None):
+    '''Returns the preprocessed images as one block of bytes to send to
+    Aquila.
+
+    prep_batch writes each image straight into its row of a buffer from
+    the pool (by default the module's), and the buffer is turned into
+    bytes once at the end.
+    '''
+    pool = pool or _request_buffers
+    with pool.buffer(len(images)) as out:
+        return prep_batch(images, out).tostring()
+
+# Memory maps of the shared slots, cached in each worker process
+_worker_slot_maps = {}
+
+def _prep_in_shared_slot(path, size, shape):
+    '''Preprocesses an image in a SharedMemoryPrepPool slot.
+
+    This runs in the worker process. The slot holds the prepped image
+    followed by the raw image.
+    '''
+    buf = _worker_slot_maps.get(path)
+    if buf is None or len(buf) != size:
+        buf = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        _worker_slot_maps[path] = buf
+    image = buf[_PREPPED_SIZE:_PREPPED_SIZE + int(np.prod(shape))]
+    buf[:_PREPPED_SIZE] = np.frombuffer(
+        _aquila_prep_image(image.reshape(shape)).tobytes(), dtype=np.uint8)
+
+class _SharedSlot(object):
+    '''A memory mapped file used to pass one image to a worker process.'''
+    def __init__(self, path):
+        self.path = path
+        self.size = 0
+        self.buf = None
+
+    def reserve(self, nbytes):
+        '''Makes sure the slot can hold at least nbytes.'''
+        if nbytes > self.size:
+            # Only ever grow the file so that stale maps in the workers
+            # stay valid.
+            with open(self.path, 'ab') as f:
+                f.truncate(nbytes)
+            self.buf = np.memmap(self.path, dtype=np.uint8, mode='r+',
+                                 shape=(nbytes,))
+            self.size = nbytes
+
+class SharedMemoryPrepPool(object):
+    '''Preprocesses images for Aquila in a pool of processes.
+
+    Images are handed to, and results returned from, the workers through
+    memory mapped files (in /dev/shm when available) rather than by
+    pickling the arrays.
+
+    The workers are forked when the pool is created, so create it before
+    starting threads, like those of gRPC channels or an IOLoopThread. A
+    child forked later could inherit a lock that another thread holds.
+    '''
+    def __init__(self, max_workers=None, directory=None):
+        '''
+        max_workers - Number of processes. Defaults to the number of cores.
+        directory - Where to put the shared files.
+        '''
+        if directory is None and os.path.isdir('/dev/shm'):
+            directory = '/dev/shm'
+        self._dir = tempfile.mkdtemp(prefix='aquila_prep_', dir=directory)
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers or multiprocessing.cpu_count())
+        # The executor forks its workers on the first submit, after it has
+        # started its own thread, so fork them now and then start the
+        # thread, which is also what tells the workers to exit at shutdown.
+        self._pool._adjust_process_count()
+        self._pool._start_queue_management_thread()
+        self._lock = threading.Lock()
+        self._free_slots = []
+        self._n_slots = 0
+
+    def _get_slot(self):
+        with self._lock:
+            if self._free_slots:
+                return self._free_slots.pop()
+            self._n_slots += 1
+            return _SharedSlot(os.path.join(self._dir,
+                                            'slot%d' % self._n_slots))
+
+    def _release_slot(self, slot):
+        with self._lock:
+            self._free_slots.append(slot)
+
+    def submit(self, image):
+        '''Preprocesses an OpenCV image in the pool.
+
+        Returns: A concurrent.futures.Future of the bytes to send to Aquila.
+        '''
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        slot = self._get_slot()
+        retval = concurrent.futures.Future()
+        try:
+            slot.reserve(_PREPPED_SIZE + image.nbytes)
+            slot.buf[_PREPPED_SIZE:_PREPPED_SIZE + image.nbytes] = \
+                image.reshape(-1)
+            future = self._pool.submit(_prep_in_shared_slot, slot.path,
+                                       slot.size, image.shape)
+        except Exception as e:
+            self._release_slot(slot)
+            retval.set_exception(e)
+            return retval
+
+        def _done(future):
+            try:
+                future.result()
+                retval.set_result(slot.buf[:_PREPPED_SIZE].tostring())
+            except Exception as e:
+                retval.set_exception(e)
+            finally:
+                self._release_slot(slot)
+        future.add_done_callback(_done)
+        return retval
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+class QuantizedFeatures(object):
+    '''A compact block of N feature vectors of length F.
+
+    With 'float16', the values are stored as half floats. With 'int8',
+    each vector x is stored as int8 codes q with its own scale and zero
+    point, so that x ~= scale * (q - zero_point). That is 1 byte per
+    feature plus 8 bytes per vector, instead of 4 bytes per feature for
+    float32.
+
+    DemographicSignatures can score these directly.
+    '''
+    DTYPES = ('float16', 'int8')
+
+    def __init__(self, values, scale=None, zero_point=None):
+        '''
+        values - N x F float16 values or int8 codes
+        scale - Length N float32 scales of the int8 codes
+        zero_point - Length N int32 zero points of the int8 codes
+        '''
+        self.values = values
+        self.scale = scale
+        self.zero_point = zero_point
+
+    @classmethod
+    def encode(cls, X, dtype='int8'):
+        '''Quantizes an N x F (or length F) float array.'''
+        if dtype not in cls.DTYPES:
+            raise ValueError('Invalid quantized dtype: %s' % dtype)
+        X = np.atleast_2d(np.asarray(X, dtype=np.float32))
+        if dtype == 'float16':
+            return cls(X.astype(np.float16))
+
+        # The range always includes 0 so that it is exactly representable
+        lo = np.minimum(X.min(axis=1), 0)
+        hi = np.maximum(X.max(axis=1), 0)
+        scale = (hi - lo) / 255.
+        scale[scale == 0] = 1.
+        zero_point = np.round(-128. - lo / scale)
+        q = np.round(X / scale[:, np.newaxis]) + zero_point[:, np.newaxis]
+        return cls(np.clip(q, -128, 127).astype(np.int8),
+                   scale.astype(np.float32),
+                   zero_point.astype(np.int32))
+
+    @property
+    def dtype(self):
+        return self.values.dtype.name
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + sum(x.nbytes for x in
+                                        (self.scale, self.zero_point)
+                                        if x is not None)
+
+    def __len__(self):
+        return self.values.shape[0]
+
+    def decode(self, start=0, stop=None):
+        '''Returns rows start to stop as a float32 array.'''
+        values = np.asarray(self.values[start:stop], dtype=np.float32)
+        if self.scale is not None:
+            values -= self.zero_point[start:stop, np.newaxis]
+            values *= self.scale[start:stop, np.newaxis]
+        return values
+
+    def dot(self, W, start=0, stop=None, out=None):
+        '''Returns rows start to stop multiplied by the F x D matrix W.
+
+        For int8, this works on the codes, as
+        scale * (q.dot(W) - zero_point * W.sum(axis=0)).
+        '''
+        codes = np.asarray(self.values[start:stop], dtype=np.float32)
+        out = np.dot(codes, W, out=out)
+        if self.scale is not None:
+            out -= (self.zero_point[start:stop, np.newaxis] *
+                    W.sum(axis=0, dtype=np.float32))
+            out *= self.scale[start:stop, np.newaxis]
+        return out
+
+    def save(self, path):
+        '''Saves the features to an .npz file.'''
+        arrays = {'values': self.values}
+        if self.scale is not None:
+            arrays['scale'] = self.scale
+            arrays['zero_point'] = self.zero_point
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        '''Loads features saved with save().'''
+        with np.load(path) as data:
+            if 'scale' in data:
+                return cls(data['values'], data['scale'], data['zero_point'])
+            return cls(data['values'])
+
+# Number of quantized vectors that are converted to float32 at a time
+# when scoring them
+_QUANTIZED_CHUNK_SIZE = 4096
+
+# Directory holding the demographic signatures for each model
+_DEMOGRAPHICS_DIR = os.path.join(os.path.dirname(__file__), '..',
+                                 'demographics')
+
+# Loads demographic signatures in the background
+_signature_loader = concurrent.futures.ThreadPoolExecutor(2)
+_prefetch_lock = threading.Lock()
+# model_name -> Future of the DemographicSignatures being loaded
+_prefetching = {}
+
+def _compiled_signature_paths(model_name, directory=None):
+    '''Returns the paths to the (.npy matrix, .json index) of a compiled
+    signature file.'''
+    base = os.path.join(directory or _DEMOGRAPHICS_DIR,
+                        '%s-signatures' % model_name)
+    return base + '.npy', base + '.json'
+
+def _signature_pickle_paths(model_name, directory=None):
+    '''Returns the paths to the (weight, bias) pickles of a model.'''
+    directory = directory or _DEMOGRAPHICS_DIR
+    return tuple(os.path.join(directory, '%s-%s.pkl' % (model_name, x))
+                 for x in ('weight', 'bias'))
+
+def _file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def _signature_sources(paths, directory):
+    '''Returns the entries for the index of a compiled form that identify
+    the files it was built from.'''
+    return [{'file': os.path.relpath(path, directory),
+             'size': os.path.getsize(path),
+             'sha1': _file_sha1(path)} for path in paths]
+
+def _check_signature_sources(index, model_name, directory=None):
+    '''Checks that the files a compiled form was built from haven't changed
+    since.
+
+    A source file that no longer exists is not checked, so a compiled form
+    can be used by itself.
+
+    Raises: ValueError if the compiled form is out of date
+    '''
+    directory = directory or _DEMOGRAPHICS_DIR
+    sources = index.get('sources')
+    if sources is None:
+        # Compiled before the sources were recorded
+        if any(os.path.exists(x) for x in
+               _signature_pickle_paths(model_name, directory)):
+            raise ValueError('The compiled signatures for %s do not record '
+                             'the pickles they were built from' % model_name)
+        return
+    for source in sources:
+        path = os.path.join(directory, source['file'])
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        if size != source['size'] or _file_sha1(path) != source['sha1']:
+            raise ValueError('%s changed after the signatures for %s were '
+                             'compiled' % (path, model_name))
+
+def _signature_file_stamp(model_name, directory=None):
+    '''Returns a value that changes whenever any of the signature files of
+    a model are changed, added or removed.'''
+    directory = directory or _DEMOGRAPHICS_DIR
+    npy_fn, json_fn = _compiled_signature_paths(model_name, directory)
+    paths = [npy_fn, json_fn]
+    paths += _signature_pickle_paths(model_name, directory)
+    # Files the compiled form was built from, like the PCA of a folded model
+    try:
+        with open(json_fn) as f:
+            paths += [os.path.join(directory, x['file'])
+                      for x in json.load(f).get('sources', [])
+                      if os.path.join(directory, x['file']) not in paths]
+    except (IOError, ValueError, KeyError, TypeError, AttributeError):
+        pass
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stamp.append((path, st.st_mtime, st.st_size, st.st_ino))
+    return tuple(stamp)
+
+def _recompile_stale_signatures(model_name, directory=None):
+    '''Compiles the pickles of a model again if its compiled form was built
+    from older versions of them.
+
+    Nothing is done for a model without a compiled form or pickles. If the
+    compiled form can't be written, DemographicSignatures falls back to
+    the pickles.
+
+    Returns: True if the signatures were compiled again
+    '''
+    directory = directory or _DEMOGRAPHICS_DIR
+    npy_fn, json_fn = _compiled_signature_paths(model_name, directory)
+    if not all(os.path.exists(x) for x in
+               _signature_pickle_paths(model_name, directory)):
+        return False
+    try:
+        with open(json_fn) as f:
+            index = json.load(f)
+    except IOError:
+        return False
+    except ValueError:
+        index = {}
+    try:
+        _check_signature_sources(index, model_name, directory)
+        return False
+    except ValueError as e:
+        _log.info('Compiling the signatures for %s again: %s' %
+                  (model_name, e))
+    try:
+        compile_signatures(model_name, directory)
+    except Exception as e:
+        _log.warn('Could not compile the signatures for %s again: %s' %
+                  (model_name, e))
+        return False
+    return True
+
+def _reload_signatures(model_name):
+    '''Loads a new DemographicSignatures for a model from its current
+    files, compiling them again first if they are stale.'''
+    _recompile_stale_signatures(model_name)
+    return DemographicSignatures.create(model_name)
+
+def compile_signatures(model_name, directory=None):
+    '''Converts the weight and bias pickles of a model to the compiled
+    format that DemographicSignatures loads quickly.
+
+    The compiled form is a D x F float32 .npy matrix with one signature
+    per row, which is opened memory mapped, and a JSON index with the
+    (gender, age) of each row and the biases.
+
+    Inputs:
+    model_name - Name of the model, e.g. 20160713-aquilav2
+    directory - Directory with the pickles. Defaults to demographics/
+
+    Returns: (path to the .npy file, path to the .json file)
+    '''
+    directory = directory or _DEMOGRAPHICS_DIR
+    sources = _signature_sources(
+        _signature_pickle_paths(model_name, directory), directory)
+    columns, signatures, bias = _read_signature_pickles(model_name, directory)
+    return _write_compiled_signatures(model_name, columns, signatures, bias,
+                                      directory, sources)
+
+def fold_pca_signatures(model_name, pca, folded_name=None, directory=None):
+    '''Folds a PCA projection into the signatures of a model.
+
+    Models like the one from aquila_export2.py output PCA features,
+    (abstract_feats - mean).dot(components.T), that the signatures are
+    applied to. Both steps are linear, so they are combined into
+    signatures W' = components.T.dot(W) and biases
+    b' = b - mean.dot(W') that score the raw abstract features directly.
+    These are written in the compiled format under folded_name, so
+    DemographicSignatures(folded_name) loads them.
+
+    Inputs:
+    model_name - Name of the model with the PCA space signatures
+    pca - A fitted sklearn PCA, or the path to one saved with joblib
+    folded_name - Name for the folded model. Defaults to <model_name>-raw
+    directory - Directory with the pickles. Defaults to demographics/
+
+    Returns: (path to the .npy file, path to the .json file)
+    '''
+    directory = directory or _DEMOGRAPHICS_DIR
+    folded_name = folded_name or '%s-raw' % model_name
+    source_paths = list(_signature_pickle_paths(model_name, directory))
+    if isinstance(pca, basestring):
+        source_paths.append(pca)
+    sources = _signature_sources(source_paths, directory)
+    components, mean = _pca_params(pca)
+    columns, signatures, bias = _read_signature_pickles(model_name, directory)
+    if components.shape[0] != signatures.shape[1]:
+        raise ValueError('The PCA has %d components but the signatures have '
+                         '%d features' % (components.shape[0],
+                                          signatures.shape[1]))
+    # Signatures are rows, so W'.T = W.T.dot(components)
+    folded = signatures.dot(components)
+    folded_bias = bias - folded.dot(mean)
+    return _write_compiled_signatures(folded_name, columns, folded,
+                                      folded_bias, directory, sources)
+
+def _pca_params(pca):
+    '''Returns the (components, mean) of a PCA as float64 arrays.'''
+    if isinstance(pca, basestring):
+        # Only needed to read the PCA, so don't require it otherwise
+        from sklearn.externals import joblib
+        pca = joblib.load(pca)
+    return (np.asarray(pca.components_, dtype=np.float64),
+            np.asarray(pca.mean_, dtype=np.float64))
+
+def _read_signature_pickles(model_name, directory):
+    '''Reads the weight and bias pickles of a model.
+
+    Returns: ((gender, age) of each signature, D x F float64 signatures,
+              length D float64 biases)
+    '''
+    weights_fn, bias_fn = _signature_pickle_paths(model_name, directory)
+    weights = pandas.read_pickle(weights_fn)
+    bias = pandas.read_pickle(bias_fn)
+    columns = [x for x in weights.columns if x in bias.columns]
+    return (columns,
+            np.asarray(weights[columns].values.T, dtype=np.float64),
+            np.asarray(bias[columns].values.reshape(-1), dtype=np.float64))
+
+def _write_compiled_signatures(model_name, columns, signatures, bias,
+                               directory, sources):
+    '''Writes signatures in the compiled format.
+
+    Inputs:
+    sources - Entries from _signature_sources for the files the
+              signatures were built from
+
+    Returns: (path to the .npy file, path to the .json file)
+    '''
+    signatures = np.ascontiguousarray(signatures, dtype='<f4')
+    index = {
+        'model_name': model_name,
+        'columns': [list(x) for x in columns],
+        'bias': [float(x) for x in np.asarray(bias).astype(np.float32)],
+        'sources': sources,
+        }
+
+    npy_fn, json_fn = _compiled_signature_paths(model_name, directory)
+    # Write to temporary files and then move them so that readers never
+    # see a partial file. The index is moved last because it is what
+    # marks the compiled form as present.
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp',
+                                     delete=False) as f:
+        np.save(f, signatures)
+    os.chmod(f.name, 0o644)
+    os.rename(f.name, npy_fn)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp',
+                                     delete=False) as f:
+        json.dump(index, f, indent=1, separators=(',', ': '))
+    os.chmod(f.name, 0o644)
+    os.rename(f.name, json_fn)
+    return npy_fn, json_fn
 
 class DemographicSignatures(object):
     '''Object that manages all the signatures for different demographics.
 
     dot this vector with your image signature and you get the model
     score for that image for that demographic.
-    
+
+    The signatures are loaded from the compiled form made by
+    compile_signatures if there is one, otherwise from the pickles.
     '''
     __metaclass__ = utils.obj.KeyedSingleton
 
     def __init__(self, model_name):
+        self.model_name = model_name
+        # Taken before loading, so a change while loading is seen later
+        self.file_stamp = _signature_file_stamp(model_name)
+        # When the signatures were last used to score, for SignatureReloader
+        self.last_used = time.time()
+        self._weights = None
+        self._bias_frame = None
+        try:
+            self._load_compiled(model_name)
+        except (IOError, ValueError, KeyError) as e:
+            npy_fn, json_fn = _compiled_signature_paths(model_name)
+            if os.path.exists(json_fn):
+                _log.warn('Could not load the compiled signatures at %s, '
+                          'falling back to the pickles: %s' % (json_fn, e))
+            self._load_pickles(model_name)
+
+        # The rows for DEMOGRAPHICS, or None if the model doesn't have
+        # them all.
+        self._demo_rows = None
+        if all((str(g), str(a)) in self._columns for g, a in DEMOGRAPHICS):
+            self._demo_rows = np.array([self._columns[(str(g), str(a))]
+                                        for g, a in DEMOGRAPHICS])
+
+        # Cache of the signatures for sets of demographics that have been
+        # asked for. tuple of (gender, age) -> (F x D weights, biases)
+        self._submatrix_lock = threading.Lock()
+        self._submatrices = collections.OrderedDict()
+        self.max_submatrices = 32
+
+    @classmethod
+    def prefetch(cls, model_name):
+        '''Loads the signatures for a model in the background.
+
+        Returns: A concurrent.futures.Future of the DemographicSignatures.
+                 Its exception is a KeyError if the model can't be loaded.
+        '''
+        signatures = cls.get_loaded(model_name)
+        if signatures is not None:
+            future = concurrent.futures.Future()
+            future.set_result(signatures)
+            return future
+
+        with _prefetch_lock:
+            future = _prefetching.get(model_name)
+            if future is not None:
+                return future
+            future = _signature_loader.submit(cls, model_name)
+            _prefetching[model_name] = future
+
+        # Added outside the lock because it runs right away if the load
+        # has already finished.
+        def _done(f):
+            with _prefetch_lock:
+                if _prefetching.get(model_name) is f:
+                    del _prefetching[model_name]
+        future.add_done_callback(_done)
+        return future
+
+    def _load_compiled(self, model_name, directory=None):
+        '''Loads the signatures from the compiled form.
+
+        The matrix is memory mapped read only, so processes on a machine
+        share the same pages.
+
+        Raises: ValueError if the compiled form is inconsistent or older
+                than the pickles it was built from
+        '''
+        npy_fn, json_fn = _compiled_signature_paths(model_name, directory)
+        with open(json_fn) as f:
+            index = json.load(f)
+        _check_signature_sources(index, model_name, directory)
+        signatures = np.load(npy_fn, mmap_mode='r')
+        columns = [tuple(str(y) for y in x) for x in index['columns']]
+        bias = np.array(index['bias'], dtype=np.float32)
+        if (signatures.dtype != np.float32 or signatures.ndim != 2 or
+            signatures.shape[0] != len(columns) or
+            bias.shape != (len(columns),)):
+            raise ValueError('Inconsistent compiled signatures for %s' %
+                             model_name)
+        self._columns = dict((x, i) for i, x in enumerate(columns))
+        self._signatures = signatures
+        self._bias = bias
+
+    def _load_pickles(self, model_name, directory=None):
+        '''Loads the signatures from the weight and bias pickles.'''
         # Load up the files
-        weights_fn = os.path.join(os.path.dirname(__file__),
-                                  '..',
-                                  'demographics',
-                                  '%s-weight.pkl' % model_name)
-        bias_fn = os.path.join(os.path.dirname(__file__),
-                               '..',
-                               'demographics',
-                               '%s-bias.pkl' % model_name)
+        weights_fn, bias_fn = _signature_pickle_paths(model_name, directory)
         try:
-            self.weights = pandas.read_pickle(weights_fn)
+            self._weights = pandas.read_pickle(weights_fn)
         except IOError as e:
             _log.error('Could not read a valid model weights file at %s: %s' % 
                        (weights_fn, e))
             raise KeyError(model_name)
         try:
-            self.bias = pandas.read_pickle(bias_fn)
+            self._bias_frame = pandas.read_pickle(bias_fn)
         except IOError as e:
             _log.error('Could not read a valid model bias file at %s: %s' % 
                        (bias_fn, e))
             raise KeyError(model_name)
 
+        # Contiguous float32 copies of the signatures that are used for
+        # scoring, so that a score is a single BLAS dot product. Row i of
+        # _signatures and entry i of _bias are for the demographic
+        # (gender, age) where _columns[(gender, age)] == i.
+        columns = [x for x in self._weights.columns
+                   if x in self._bias_frame.columns]
+        self._columns = dict((x, i) for i, x in enumerate(columns))
+        self._signatures = np.ascontiguousarray(
+            self._weights[columns].values.T, dtype=np.float32)
+        self._bias = np.ascontiguousarray(
+            self._bias_frame[columns].values.reshape(-1), dtype=np.float32)
+
+    def _column_index(self):
+        '''Returns the (gender, age) MultiIndex of the signature rows.'''
+        columns = sorted(self._columns, key=self._columns.get)
+        return pandas.MultiIndex.from_tuples(columns)
+
+    @property
+    def weights(self):
+        '''The F x D weights as a pandas DataFrame with a (gender, age)
+        column MultiIndex.'''
+        if self._weights is None:
+            self._weights = pandas.DataFrame(
+                np.asarray(self._signatures).T.astype(np.float64),
+                columns=self._column_index())
+        return self._weights
+
+    @property
+    def bias(self):
+        '''The 1 x D biases as a pandas DataFrame with a (gender, age)
+        column MultiIndex.'''
+        if self._bias_frame is None:
+            self._bias_frame = pandas.DataFrame(
+                self._bias[np.newaxis].astype(np.float64),
+                columns=self._column_index())
+        return self._bias_frame
+
+    def _column(self, gender, age):
+        '''Returns the index of the demographic in _signatures.'''
+        self.last_used = time.time()
+        if gender is None:
+            gender = 'None'
+        if age is None:
+            age = 'None'
+        try:
+            return self._columns[(gender, age)]
+        except KeyError as e:
+            _log.error_n('Unknown Demographic: %s,%s' % (gender, age))
+            raise
+
     def _safe_get_weights(self, gender, age):
         if gender is None:
             gender = 'None'
@@ -193,19 +909,129 @@ class DemographicSignatures(object):
         '''Returns the score for gender `gender` and age `age` derived from
         feature vector X (a numpy array)
         '''
-        X = pandas.Series(X)
-
-        b = self._safe_get_bias(gender, age)
-        W = self._safe_get_weights(gender, age)
-        try:
-            score = X.dot(W) + b
-        except ValueError as e:
-            _log.error('Improper feature vector size: %s' % e.message)
-            raise ValueError(e)
-        # return score
+        i = self._column(gender, age)
+        X = np.asarray(X, dtype=np.float32)
+        if X.shape != self._signatures.shape[1:]:
+            msg = ('Improper feature vector size: %s, expected %s' %
+                   (X.shape, self._signatures.shape[1:]))
+            _log.error(msg)
+            raise ValueError(msg)
         # for now, we're nto going to return the score as multiindex 
         # series objects, but simply as floats.
-        return float(score)
+        return float(self._signatures[i].dot(X) + self._bias[i])
+
+    def _submatrix(self, demographics):
+        '''Returns the (F x D weights, length D biases) for a list of
+        (gender, age) demographics.'''
+        # Cache hits don't go through _column, so note the use here
+        self.last_used = time.time()
+        key = tuple(tuple(x) for x in demographics)
+        with self._submatrix_lock:
+            cached = self._submatrices.pop(key, None)
+            if cached is not None:
+                self._submatrices[key] = cached
+                return cached
+
+        rows = [self._column(gender, age) for gender, age in key]
+        cached = (np.ascontiguousarray(self._signatures[rows].T),
+                  self._bias[rows])
+        with self._submatrix_lock:
+            self._submatrices[key] = cached
+            while len(self._submatrices) > self.max_submatrices:
+                self._submatrices.popitem(last=False)
+        return cached
+
+    def _scores(self, X, W, b, chunk_size):
+        '''Returns the N x D matrix of scores for the feature matrix X and
+        the F x D weights W and length D biases b.'''
+        quantized = isinstance(X, QuantizedFeatures)
+        if quantized:
+            chunk_size = chunk_size or _QUANTIZED_CHUNK_SIZE
+        else:
+            X = np.asanyarray(X)
+        if len(X.shape) != 2 or X.shape[1] != self._signatures.shape[1]:
+            msg = ('Improper feature matrix size: %s, expected N x %s' %
+                   (X.shape, self._signatures.shape[1]))
+            _log.error(msg)
+            raise ValueError(msg)
+        n = X.shape[0]
+        chunk_size = chunk_size or max(n, 1)
+        scores = np.empty((n, W.shape[1]), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            # Only a chunk of X is converted to float32 at a time, so X can
+            # be a memory map of a large archive.
+            stop = start + chunk_size
+            if quantized:
+                X.dot(W, start, stop, out=scores[start:stop])
+                continue
+            chunk = np.asarray(X[start:stop], dtype=np.float32)
+            np.dot(chunk, W, out=scores[start:stop])
+        scores += b
+        return scores
+
+    def compute_scores_for_demo(self, X, gender=None, age=None,
+                                chunk_size=None):
+        '''Returns the scores for gender `gender` and age `age` for many
+        images.
+
+        Inputs:
+        X - N x F feature matrix, one image per row, or QuantizedFeatures
+        chunk_size - If set, the maximum number of rows to score at once
+
+        Returns: A length N float32 numpy array of scores
+        '''
+        i = self._column(gender, age)
+        return self._scores(X, self._signatures[i:i + 1].T,
+                            self._bias[i:i + 1], chunk_size)[:, 0]
+
+    def compute_scores_for_demos(self, X, demographics, chunk_size=None):
+        '''Returns the scores for a list of demographics.
+
+        The signatures for a list of demographics are gathered once and
+        cached, so asking for the same list again is a single matrix
+        product.
+
+        Inputs:
+        X - Feature vector of one image, or N x F feature matrix, or
+            QuantizedFeatures
+        demographics - List of (gender, age) tuples or 'all' for
+                       DEMOGRAPHICS
+        chunk_size - If set, the maximum number of rows to score at once
+
+        Returns: A float32 numpy array with a score for each demographic,
+                 in the same order. It is N x D if X is a matrix.
+        '''
+        if isinstance(demographics, basestring):
+            if demographics != 'all':
+                raise ValueError('Invalid demographics: %s' % demographics)
+            demographics = DEMOGRAPHICS
+        W, b = self._submatrix(demographics)
+        if isinstance(X, QuantizedFeatures):
+            return self._scores(X, W, b, chunk_size)
+        X = np.asanyarray(X)
+        if X.ndim == 1:
+            return self._scores(X[np.newaxis], W, b, chunk_size)[0]
+        return self._scores(X, W, b, chunk_size)
+
+    def get_scores_for_all_demos_batch(self, X, chunk_size=None):
+        '''Returns the scores for all demographics for many images.
+
+        This is a single matrix product, optionally done over chunks of
+        rows to bound the memory used.
+
+        Inputs:
+        X - N x F feature matrix, one image per row, or QuantizedFeatures
+        chunk_size - If set, the maximum number of rows to score at once
+
+        Returns: An N x len(DEMOGRAPHICS) float32 numpy array, where
+                 column j is the score for the demographic DEMOGRAPHICS[j]
+        '''
+        self.last_used = time.time()
+        if self._demo_rows is None:
+            _log.error_n('Model is missing some demographics')
+            raise KeyError('Missing demographics')
+        W, b = self._submatrix(DEMOGRAPHICS)
+        return self._scores(X, W, b, chunk_size)
 
     def get_scores_for_all_demos(self, X):
         '''Returns the scores for all demographics.
@@ -237,8 +1063,167 @@ class DemographicSignatures(object):
         W = self._safe_get_weights(gender, age)
 
         importance = W * X
-        return importance.sort(ascending=False, inplace=False)
+        return importance.sort_values(ascending=False)
+
+    def compute_feature_importance_batch(self, X, k=20, gender=None,
+                                         age=None):
+        '''Returns the most important features for many images.
+
+        The importance of a feature is its contribution to the score,
+        X * W. Only the top k are found for each image, so nothing is
+        fully sorted.
+
+        Inputs:
+        X - N x F feature matrix, one image per row
+        k - Number of features to return for each image
+
+        Returns: (indices, contributions) where both are N x min(k, F)
+                 arrays and row i holds the most important features of
+                 image i, most important first
+        '''
+        i = self._column(gender, age)
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim != 2 or X.shape[1] != self._signatures.shape[1]:
+            msg = ('Improper feature matrix size: %s, expected N x %s' %
+                   (X.shape, self._signatures.shape[1]))
+            _log.error(msg)
+            raise ValueError(msg)
+        contributions = X * self._signatures[i]
+        indices = top_k(contributions.T, k).T
+        return (indices,
+                np.take_along_axis(contributions, indices, axis=1))
     
+class SignatureReloader(object):
+    '''Keeps the loaded DemographicSignatures in step with their files.
+
+    Every interval, the files of each loaded model are checked on the
+    IOLoop. Models whose files changed are loaded again in the background,
+    compiling the pickles again if they are newer than the compiled form,
+    and the new DemographicSignatures is swapped in as a whole, so any
+    scoring that already has the old one finishes with a consistent set
+    of signatures. At most max_versions models are kept loaded. The least
+    recently used ones are dropped and are loaded again if they are needed.
+
+    To use it, on a running IOLoop:
+    reloader = SignatureReloader(interval=60.0)
+    reloader.start()
+    '''
+    def __init__(self, interval=60.0, max_versions=4, io_loop=None):
+        '''
+        interval - Seconds between checks of the files.
+        max_versions - Maximum number of models to keep loaded.
+        io_loop - IOLoop to run on. Defaults to the current one.
+        '''
+        self.max_versions = max_versions
+        self._timer = utils.sync.PeriodicCoroutineTimer(
+            self.check, interval * 1000., io_loop)
+        # model_name -> file stamp that failed to load
+        self._failed = {}
+
+        self.reloads = 0
+        self.evictions = 0
+
+    def start(self):
+        self._timer.start()
+
+    def stop(self):
+        self._timer.stop()
+
+    @tornado.gen.coroutine
+    def check(self):
+        '''Reloads the models whose files changed and evicts unused ones.'''
+        for model_name in DemographicSignatures.loaded_keys():
+            current = DemographicSignatures.get_loaded(model_name)
+            stamp = _signature_file_stamp(model_name)
+            if (current is None or stamp == current.file_stamp or
+                stamp == self._failed.get(model_name)):
+                continue
+            try:
+                new = yield _signature_loader.submit(_reload_signatures,
+                                                     model_name)
+            except Exception as e:
+                _log.error('Could not reload the signatures for %s, still '
+                           'using the old ones: %s' % (model_name, e))
+                self._failed[model_name] = stamp
+                continue
+            self._failed.pop(model_name, None)
+            new.last_used = current.last_used
+            DemographicSignatures.replace_instance(model_name, new)
+            self.reloads += 1
+            _log.info('Reloaded the signatures for %s' % model_name)
+
+        loaded = [DemographicSignatures.get_loaded(x)
+                  for x in DemographicSignatures.loaded_keys()]
+        loaded = sorted([x for x in loaded if x is not None],
+                        key=lambda x: x.last_used, reverse=True)
+        for signatures in loaded[self.max_versions:]:
+            DemographicSignatures.remove_instance(signatures.model_name)
+            self.evictions += 1
+            _log.info('Unloaded the signatures for %s' %
+                      signatures.model_name)
+
+def top_k(scores, k):
+    '''Returns the indices of the k highest scoring candidates for each
+    demographic.
+
+    Inputs:
+    scores - N x D score matrix, e.g. from
+             DemographicSignatures.get_scores_for_all_demos_batch
+    k - Number of candidates to return
+
+    Returns: A min(k, N) x D array where column j holds the indices of the
+             best candidates for demographic j, best first
+    '''
+    scores = np.asarray(scores)
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty((0,) + scores.shape[1:], dtype=np.intp)
+    if k < scores.shape[0]:
+        idx = np.argpartition(-scores, k - 1, axis=0)[:k]
+    else:
+        idx = np.broadcast_to(
+            np.arange(scores.shape[0]).reshape((-1,) + (1,) * (scores.ndim - 1)),
+            scores.shape)
+    # Only the k candidates are sorted
+    order = np.argsort(-np.take_along_axis(scores, idx, axis=0), axis=0,
+                       kind='mergesort')
+    return np.take_along_axis(idx, order, axis=0)
+
+def lift(scores, baseline):
+    '''Returns the lift of candidates over a baseline.
+
+    The lift of A over B is exp(A) / exp(B) - 1, which is computed as
+    expm1(A - B) so that it is accurate for small differences and doesn't
+    overflow for large scores.
+
+    Inputs:
+    scores - N x D score matrix
+    baseline - Either the index of the baseline candidate in scores, or
+               its scores, a length D array (or a scalar)
+
+    Returns: An N x D array of lifts
+    '''
+    scores = np.asarray(scores)
+    if isinstance(baseline, (int, long, np.integer)):
+        baseline = scores[baseline]
+    return np.expm1(scores - np.asarray(baseline))
+
+def pairwise_lift(scores, max_candidates=1000):
+    '''Returns the lift of every candidate over every other one.
+
+    Inputs:
+    scores - N x D score matrix
+    max_candidates - Largest N allowed, since the result is N x N x D
+
+    Returns: An N x N x D array where [a, b, j] is the lift of candidate a
+             over candidate b for demographic j
+    '''
+    scores = np.asarray(scores)
+    if scores.shape[0] > max_candidates:
+        raise ValueError('Too many candidates for a pairwise lift: %d > %d' %
+                         (scores.shape[0], max_candidates))
+    return np.expm1(scores[:, np.newaxis] - scores[np.newaxis, :])
+
 class Predictor(object):
     '''An abstract valence predictor.
 
@@ -300,14 +1285,38 @@ class Predictor(object):
 
         Raises: NotTrainedError if it has been called before train() has.
         '''
-        cur_try = 0
         kwargs['timeout'] = timeout
+        result = yield self._retry(self._predict, ntries, base_time, image,
+                                   *args, **kwargs)
+        raise tornado.gen.Return(result)
+
+    @utils.sync.optional_sync
+    @tornado.gen.coroutine
+    def predict_batch(self, images, ntries=3, timeout=10.0, base_time=0.4,
+                      *args, **kwargs):
+        '''Predicts the valence scores of a batch of images.
+
+        Inputs:
+        images - list of numpy arrays of the images
+
+        Returns: (N predicted valence scores, N x D feature matrix,
+                  model_version) any can be None
+        '''
+        kwargs['timeout'] = timeout
+        result = yield self._retry(self._predict_batch, ntries, base_time,
+                                   images, *args, **kwargs)
+        raise tornado.gen.Return(result)
+
+    @tornado.gen.coroutine
+    def _retry(self, func, ntries, base_time, *args, **kwargs):
+        '''Calls the coroutine func up to ntries times, backing off
+        exponentially between tries.'''
+        cur_try = 0
         while cur_try < ntries:
             cur_try += 1
             try:
-                score, vec, vers = yield self._predict(image,
-                                                       *args, **kwargs)
-                raise tornado.gen.Return((score, vec, vers))
+                result = yield func(*args, **kwargs)
+                raise tornado.gen.Return(result)
             except tornado.gen.Return:
                 raise
             except PredictionError as e:
@@ -337,6 +1346,18 @@ class Predictor(object):
         '''
         raise NotImplementedError()
 
+    @tornado.gen.coroutine
+    def _predict_batch(self, images, *args, **kwargs):
+        '''Predicts the valence scores of a batch of images.
+
+        Inputs:
+        images - list of numpy arrays of the images
+
+        Returns: (N predicted valence scores, N x D feature matrix,
+                  model_version) any can be None
+        '''
+        raise NotImplementedError()
+
     def reset(self):
         '''Resets the predictor by removing all the data/model.'''
         raise NotImplementedError()
@@ -372,6 +1393,241 @@ def deepnet_conn_callback(predictor, status):
     if self:
         self._check_conn(status)
 
+def _pool_conn_callback(pool, host, status):
+    '''A channel callback for an AquilaChannelPool that uses a weak
+    reference to avoid a circular reference.'''
+    self = pool()
+    if self:
+        self._check_conn(host, status)
+
+def _pool_ready_callback(predictor, ready):
+    '''An AquilaChannelPool ready callback that uses a weak reference to
+    avoid a circular reference.'''
+    self = predictor()
+    if self:
+        self._pool_ready(ready)
+
+class _Backend(object):
+    '''A channel to one Aquila server in an AquilaChannelPool.
+
+    The callback is not subscribed to the channel until subscribe() is
+    called, so the pool can register the backend first and see every
+    change in its connectivity.
+    '''
+    def __init__(self, host, port, concurrency, callback):
+        '''
+        host - Address of the server. If it is host:port, the port
+        overrides the pool's.
+        callback - Called with the ChannelConnectivity of the channel.
+        '''
+        self.host = host
+        if host.count(':') == 1:
+            host, port = host.split(':')
+            port = int(port)
+        self.outstanding = 0
+        self.ready = False
+        self.calls = 0
+        self.channel = implementations.insecure_channel(host, port)
+        self.stub = aquila_inference_pb2.beta_create_AquilaService_stub(
+            self.channel, pool_size=concurrency)
+        self._callback = callback
+        self._subscribed = False
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        '''Starts connecting and watching the connectivity of the channel.
+
+        Does nothing if the backend has been closed.
+        '''
+        with self._lock:
+            if self.channel is None or self._subscribed:
+                return
+            self._subscribed = True
+            self.channel.subscribe(self._callback, try_to_connect=True)
+
+    def close(self):
+        with self._lock:
+            if self.channel is not None and self._subscribed:
+                self.channel.unsubscribe(self._callback)
+            self._callback = None
+            self.stub = None
+            self.channel = None
+
+class AquilaChannelPool(object):
+    '''Channels to several Aquila servers, with each call routed to the
+    least loaded one.
+
+    The servers come from the get_ips method of the connection provider,
+    which returns a list of addresses, or from its get_ip method if it
+    only has that, which makes a pool of one. The list is refreshed in the
+    background every refresh_interval seconds, and when a server fails,
+    and channels are opened and closed to match it.
+
+    A call goes to the ready server with the fewest outstanding calls
+    ('least_outstanding'), or to the less loaded of two random ready
+    servers ('power_of_two'), which spreads the load better when there
+    are many clients.
+    '''
+    POLICIES = ('least_outstanding', 'power_of_two')
+
+    def __init__(self, aquila_connection, port, concurrency=10,
+                 policy='least_outstanding', refresh_interval=30.0,
+                 ready_callback=None):
+        '''
+        aquila_connection - Provider of the server addresses through
+        get_ips(force_refresh), or get_ip(force_refresh) for one server.
+        port - Port of the servers, unless an address includes one.
+        concurrency - Thread pool size of each stub.
+        policy - How to choose a server. One of POLICIES.
+        refresh_interval - Seconds between refreshes of the server list.
+        ready_callback - Called with True when a server becomes ready
+        and none was, and with False when none are ready any more.
+        '''
+        if policy not in self.POLICIES:
+            raise ValueError('Invalid balancing policy: %s' % policy)
+        self.aq_conn = aquila_connection
+        self.port = port
+        self.concurrency = concurrency
+        self.policy = policy
+        self.refresh_interval = refresh_interval
+        self.ready_callback = ready_callback
+        self._lock = threading.RLock()
+        self._backends = {}
+        self._any_ready = False
+        self._last_refresh = 0.0
+        self._refreshing = False
+        self._closed = False
+
+    def refresh(self, force_refresh=False):
+        '''Opens and closes channels to match the provider's list.'''
+        if hasattr(self.aq_conn, 'get_ips'):
+            hosts = set(self.aq_conn.get_ips(force_refresh=force_refresh))
+        else:
+            hosts = set([self.aq_conn.get_ip(force_refresh=force_refresh)])
+        with self._lock:
+            self._last_refresh = time.time()
+            if self._closed:
+                return
+            removed = [self._backends.pop(x) for x in self._backends.keys()
+                       if x not in hosts]
+            added = hosts - set(self._backends)
+        for backend in removed:
+            _log.info('Removing Aquila server %s' % backend.host)
+            backend.close()
+
+        weak_self = weakref.ref(self)
+        for host in added:
+            _log.info('Adding Aquila server %s' % host)
+            backend = _Backend(
+                host, self.port, self.concurrency,
+                lambda status, host=host: _pool_conn_callback(
+                    weak_self, host, status))
+            with self._lock:
+                if self._closed or host in self._backends:
+                    backend.close()
+                    continue
+                self._backends[host] = backend
+            # Only subscribed once it is registered, because _check_conn
+            # ignores the states of hosts that aren't.
+            backend.subscribe()
+        self._update_ready()
+
+    def _refresh_in_background(self, force_refresh=False):
+        '''Starts a refresh in a thread if one isn't running.'''
+        with self._lock:
+            if self._refreshing or self._closed:
+                return
+            self._refreshing = True
+
+        def _run():
+            try:
+                self.refresh(force_refresh)
+            except Exception as e:
+                _log.error('Could not refresh the Aquila servers: %s' % e)
+            finally:
+                with self._lock:
+                    self._refreshing = False
+        thread = threading.Thread(target=_run, name='AquilaPoolRefresh')
+        thread.daemon = True
+        thread.start()
+
+    def acquire(self, exclude=None):
+        '''Chooses a server for a call.
+
+        Inputs:
+        exclude - Optional _Backend not to choose
+
+        Returns: The _Backend to use, which must be given to release()
+                 afterwards, or None if no server is ready
+        '''
+        if time.time() - self._last_refresh > self.refresh_interval:
+            self._refresh_in_background()
+        with self._lock:
+            ready = [x for x in self._backends.itervalues()
+                     if x.ready and x is not exclude]
+            if not ready:
+                return None
+            if self.policy == 'power_of_two' and len(ready) > 2:
+                ready = random.sample(ready, 2)
+            else:
+                # Break ties at random
+                random.shuffle(ready)
+            backend = min(ready, key=lambda x: x.outstanding)
+            backend.outstanding += 1
+            backend.calls += 1
+            return backend
+
+    def release(self, backend):
+        '''Marks a call from acquire() as done.'''
+        with self._lock:
+            backend.outstanding -= 1
+
+    def _check_conn(self, host, status):
+        with self._lock:
+            backend = self._backends.get(host)
+            if backend is None:
+                return
+            failed = (status is ChannelConnectivity.TRANSIENT_FAILURE or
+                      status is ChannelConnectivity.FATAL_FAILURE)
+            if status is ChannelConnectivity.READY:
+                if not backend.ready:
+                    _log.debug('Aquila server %s is ready' % host)
+                backend.ready = True
+            elif failed:
+                if backend.ready:
+                    _log.warn('Lost connection to Aquila server %s' % host)
+                backend.ready = False
+        self._update_ready()
+        if failed:
+            # The server may have gone away, so check with the provider
+            self._refresh_in_background(force_refresh=True)
+
+    def _update_ready(self):
+        with self._lock:
+            any_ready = any(x.ready for x in self._backends.itervalues())
+            changed = any_ready != self._any_ready
+            self._any_ready = any_ready
+        if changed and self.ready_callback is not None:
+            self.ready_callback(any_ready)
+
+    def stats(self):
+        '''Returns a dictionary of host -> dictionary of counters.'''
+        with self._lock:
+            return dict((x.host, {'ready': x.ready,
+                                  'outstanding': x.outstanding,
+                                  'calls': x.calls})
+                        for x in self._backends.itervalues())
+
+    def close(self):
+        '''Closes all the channels.'''
+        with self._lock:
+            self._closed = True
+            backends = self._backends.values()
+            self._backends = {}
+        for backend in backends:
+            backend.close()
+        self._update_ready()
+
 class GRPCFutureWrapper(concurrent.futures.Future):
     '''Wraps a GRPCFuture so that it looks like a concurrent one.'''
     def __init__(self, future):
@@ -382,6 +1638,742 @@ class GRPCFutureWrapper(concurrent.futures.Future):
             return super(GRPCFutureWrapper, self).__getattribute__(name)
         return getattr(self._future, name)
 
+class _LimiterWaiter(object):
+    '''A call waiting in an AdaptiveConcurrencyLimiter's queue.'''
+    __slots__ = ['io_loop', 'future']
+
+    def __init__(self):
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.future = tornado.concurrent.Future()
+
+class AdaptiveConcurrencyLimiter(object):
+    '''Limits the calls in flight to the server, adapting the limit to the
+    latency like TCP Vegas.
+
+    The lowest recent latency is taken as the time of a call that doesn't
+    wait in the server's queue. From each call's latency, the number of
+    calls queued in the server is estimated as
+    limit * (1 - min_rtt / rtt). The limit grows by one while fewer than
+    alpha calls are queued and shrinks by one while more than beta are.
+    When a call fails, such as when it times out in a full queue, the limit
+    is cut by backoff_ratio.
+
+    Calls over the limit wait in a FIFO queue of up to max_queue calls.
+    acquire() may be called from coroutines on any IOLoop in any thread.
+    '''
+    def __init__(self, initial_limit=10, min_limit=1, max_limit=500,
+                 max_queue=1000, alpha=3, beta=6, backoff_ratio=0.9,
+                 rtt_window=60.0):
+        '''
+        initial_limit - Calls allowed in flight at the start.
+        min_limit, max_limit - Bounds on the limit.
+        max_queue - Calls that can wait before new ones are rejected.
+        alpha, beta - Bounds on the estimated server queue that the limit
+        is adjusted to stay between.
+        backoff_ratio - Factor the limit is multiplied by on a failure.
+        rtt_window - Seconds over which the lowest latency is remembered,
+        so that the limit follows changes in the server.
+        '''
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.alpha = alpha
+        self.beta = beta
+        self.backoff_ratio = backoff_ratio
+        self.rtt_window = rtt_window
+
+        self._lock = threading.Lock()
+        self._limit = float(min(max(initial_limit, min_limit), max_limit))
+        self._in_flight = 0
+        self._waiters = collections.deque()
+        # Lowest latency in the previous and current windows
+        self._min_rtt = None
+        self._window_min_rtt = None
+        self._window_start = time.time()
+
+        self.rejections = 0
+
+    @property
+    def limit(self):
+        '''The current number of calls allowed in flight.'''
+        return int(self._limit)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depth(self):
+        '''The number of calls waiting for a slot.'''
+        return len(self._waiters)
+
+    @property
+    def min_rtt(self):
+        return self._min_rtt
+
+    def stats(self):
+        '''Returns a dictionary of the limiter's state.'''
+        with self._lock:
+            return {'limit': int(self._limit),
+                    'in_flight': self._in_flight,
+                    'queue_depth': len(self._waiters),
+                    'rejections': self.rejections,
+                    'min_rtt': self._min_rtt}
+
+    @tornado.gen.coroutine
+    def acquire(self, timeout=None):
+        '''Waits for a slot to make a call in.
+
+        Inputs:
+        timeout - Seconds to wait for the slot. None waits forever.
+
+        Returns: The start time of the call, to pass to release()
+
+        Raises: ConcurrencyLimitError if the queue is full or the timeout
+                expires.
+        '''
+        with self._lock:
+            if self._in_flight < int(self._limit) and not self._waiters:
+                self._in_flight += 1
+                raise tornado.gen.Return(time.time())
+            if len(self._waiters) >= self.max_queue:
+                self.rejections += 1
+                raise ConcurrencyLimitError(
+                    'Too many calls waiting for the server: %d' %
+                    len(self._waiters))
+            waiter = _LimiterWaiter()
+            self._waiters.append(waiter)
+
+        try:
+            if timeout is None:
+                yield waiter.future
+            else:
+                yield tornado.gen.with_timeout(
+                    datetime.timedelta(seconds=timeout), waiter.future)
+        except tornado.gen.TimeoutError:
+            with self._lock:
+                try:
+                    self._waiters.remove(waiter)
+                except ValueError:
+                    # It was given a slot just as it timed out, so use it
+                    pass
+                else:
+                    self.rejections += 1
+                    raise ConcurrencyLimitError(
+                        'Timed out waiting for the server after %gs' %
+                        timeout)
+        raise tornado.gen.Return(time.time())
+
+    def try_acquire(self):
+        '''Takes a slot only if one is free now.
+
+        Returns: The start time of the call, to pass to release(), or None
+        '''
+        with self._lock:
+            if self._in_flight < int(self._limit) and not self._waiters:
+                self._in_flight += 1
+                return time.time()
+        return None
+
+    def release(self, start_time, failed=False):
+        '''Marks a call from acquire() as done.
+
+        Inputs:
+        start_time - Value returned from acquire()
+        failed - True if the call failed
+        '''
+        now = time.time()
+        with self._lock:
+            in_flight = self._in_flight
+            self._in_flight -= 1
+            if failed:
+                self._limit = max(self.min_limit,
+                                  self._limit * self.backoff_ratio)
+            else:
+                self._update_limit(now - start_time, in_flight, now)
+            self._wake_waiters()
+
+    def cancel(self):
+        '''Gives back a slot from acquire() that wasn't used for a call.'''
+        with self._lock:
+            self._in_flight -= 1
+            self._wake_waiters()
+
+    def _update_limit(self, rtt, in_flight, now):
+        '''Adjusts the limit from a call's latency. Must hold the lock.'''
+        if now - self._window_start > self.rtt_window:
+            self._min_rtt = self._window_min_rtt
+            self._window_min_rtt = None
+            self._window_start = now
+        if self._window_min_rtt is None or rtt < self._window_min_rtt:
+            self._window_min_rtt = rtt
+        if self._min_rtt is None or rtt < self._min_rtt:
+            self._min_rtt = rtt
+
+        # When far fewer calls are made than allowed, the latency says
+        # nothing about whether more would be too many.
+        if in_flight * 2 < self._limit or rtt <= 0:
+            return
+        queued = self._limit * (1.0 - self._min_rtt / rtt)
+        if queued < self.alpha:
+            self._limit = min(self.max_limit, self._limit + 1)
+        elif queued > self.beta:
+            self._limit = max(self.min_limit, self._limit - 1)
+
+    def _wake_waiters(self):
+        '''Hands free slots to the waiters in order. Must hold the lock.'''
+        while self._waiters and self._in_flight < int(self._limit):
+            waiter = self._waiters.popleft()
+            self._in_flight += 1
+            waiter.io_loop.add_callback(waiter.future.set_result, None)
+
+class HedgingPolicy(object):
+    '''Decides when to send a duplicate of a slow call to another server.
+
+    The latencies of the last window calls are kept, and a call that
+    hasn't finished after the given percentile of them is hedged. To bound
+    the extra load, each call earns budget hedges, up to max_burst, and
+    each hedge spends one, so at most about budget of the calls are sent
+    twice.
+    '''
+    def __init__(self, percentile=95.0, budget=0.05, window=1000,
+                 min_samples=100, max_burst=10.0):
+        '''
+        percentile - Percentile of the latency to hedge at.
+        budget - Fraction of the calls that may be hedged.
+        window - Number of recent latencies to keep.
+        min_samples - Latencies needed before hedging starts.
+        max_burst - Maximum number of hedges that can be saved up.
+        '''
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self._lock = threading.Lock()
+        self._latencies = np.zeros(window)
+        self._nlatencies = 0
+        self._delay = None
+        self._tokens = 0.0
+
+        self.calls = 0
+        self.hedges = 0
+        # Hedges that answered first
+        self.wins = 0
+
+    def record(self, latency):
+        '''Records the latency in seconds of a successful call.'''
+        with self._lock:
+            window = len(self._latencies)
+            self._latencies[self._nlatencies % window] = latency
+            self._nlatencies += 1
+            n = self._nlatencies
+            if n >= self.min_samples and n % max(window // 20, 1) == 0:
+                self._delay = np.percentile(self._latencies[:min(n, window)],
+                                            self.percentile)
+
+    def hedge_delay(self):
+        '''Called at the start of each call.
+
+        Returns: Seconds after which the call should be hedged, or None if
+                 there isn't enough history yet
+        '''
+        with self._lock:
+            self.calls += 1
+            self._tokens = min(self.max_burst, self._tokens + self.budget)
+            return self._delay
+
+    def try_hedge(self):
+        '''Spends from the budget for a hedge.
+
+        Returns: True if the budget allows it
+        '''
+        with self._lock:
+            if self._tokens < 1.0:
+                return False
+            self._tokens -= 1.0
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        '''Records that a hedge answered before the original call.'''
+        with self._lock:
+            self.wins += 1
+
+    def stats(self):
+        '''Returns a dictionary of the policy's state.'''
+        with self._lock:
+            return {'calls': self.calls,
+                    'hedges': self.hedges,
+                    'wins': self.wins,
+                    'delay': self._delay}
+
+class _MicroBatch(object):
+    '''Images collected by a MicroBatcher on one IOLoop.'''
+    def __init__(self):
+        self.opened = time.time()
+        # List of (image_data, deadline, Future)
+        self.entries = []
+        self.flushed = False
+
+class MicroBatcher(object):
+    '''Collects the images of concurrent predict() calls into batched
+    calls.
+
+    The first image to arrive on an IOLoop opens a batch, which is sent
+    once it has max_images images or window seconds after it opened. The
+    outputs are then handed back to each caller. Each caller keeps its own
+    deadline, and images whose callers have given up are dropped from the
+    batch. If a batched call fails, its images are sent one by one, so
+    that one bad image doesn't fail the others.
+
+    The number of images in each flush and the time from a batch opening
+    to its flush are kept as histograms for tuning.
+    '''
+    # Upper edges, in ms, of the flush latency histogram bins
+    LATENCY_BINS_MS = (1, 2, 5, 10, 20, 50, 100, float('inf'))
+
+    def __init__(self, send, window=0.005, max_images=_MAX_BATCH_IMAGES):
+        '''
+        send - Coroutine function send(list of image_data, timeout) that
+        returns (N x F outputs, model version).
+        window - Maximum seconds for an image to wait for others.
+        max_images - Maximum images in a batch.
+        '''
+        self.send = send
+        self.window = window
+        self.max_images = max_images
+        self._lock = threading.Lock()
+        # IOLoop -> _MicroBatch being filled
+        self._pending = {}
+
+        self.flush_sizes = collections.Counter()
+        self.flush_latency = [0] * len(self.LATENCY_BINS_MS)
+        self.isolated_failures = 0
+
+    @tornado.gen.coroutine
+    def submit(self, image_data, timeout):
+        '''Adds an image to the next batch.
+
+        Inputs:
+        image_data - The preprocessed image
+        timeout - Seconds until the caller gives up
+
+        Returns: (outputs for the image, model version)
+
+        Raises: PredictionError if the call fails or times out
+        '''
+        io_loop = tornado.ioloop.IOLoop.current()
+        future = tornado.concurrent.Future()
+        with self._lock:
+            batch = self._pending.get(io_loop)
+            if batch is None:
+                batch = _MicroBatch()
+                self._pending[io_loop] = batch
+                io_loop.call_later(self.window, self._flush, io_loop, batch)
+            batch.entries.append((image_data, time.time() + timeout, future))
+            full = len(batch.entries) >= self.max_images
+        if full:
+            self._flush(io_loop, batch)
+
+        try:
+            result = yield tornado.gen.with_timeout(
+                datetime.timedelta(seconds=timeout), future)
+        except tornado.gen.TimeoutError:
+            raise PredictionError('Timed out after %gs in a batch' % timeout)
+        raise tornado.gen.Return(result)
+
+    def _flush(self, io_loop, batch):
+        '''Sends a batch if it hasn't been already.'''
+        with self._lock:
+            if batch.flushed:
+                return
+            batch.flushed = True
+            if self._pending.get(io_loop) is batch:
+                del self._pending[io_loop]
+        io_loop.add_future(self._send_batch(batch), lambda f: f.result())
+
+    @tornado.gen.coroutine
+    def _send_batch(self, batch):
+        now = time.time()
+        entries = [x for x in batch.entries if x[1] > now]
+        with self._lock:
+            self.flush_sizes[len(entries)] += 1
+            latency_ms = 1000. * (now - batch.opened)
+            for i, edge in enumerate(self.LATENCY_BINS_MS):
+                if latency_ms <= edge:
+                    self.flush_latency[i] += 1
+                    break
+        if not entries:
+            return
+
+        try:
+            valence, vers = yield self.send(
+                [x[0] for x in entries], max(x[1] for x in entries) - now)
+        except Exception as e:
+            if len(entries) == 1:
+                if not entries[0][2].done():
+                    entries[0][2].set_exception(e)
+                return
+            _log.warn('Batch of %d images failed, sending them one by one: '
+                      '%s' % (len(entries), e))
+            yield [self._send_one(x) for x in entries]
+            return
+        for i, (image_data, deadline, future) in enumerate(entries):
+            if not future.done():
+                future.set_result((valence[i], vers))
+
+    @tornado.gen.coroutine
+    def _send_one(self, entry):
+        '''Sends the image of a failed batch by itself.'''
+        image_data, deadline, future = entry
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            return
+        try:
+            valence, vers = yield self.send([image_data], timeout)
+        except Exception as e:
+            with self._lock:
+                self.isolated_failures += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        if not future.done():
+            future.set_result((valence[0], vers))
+
+    def stats(self):
+        '''Returns a dictionary of the histograms.
+
+        flush_sizes is a dictionary of images in a flush -> count.
+        flush_latency_ms is a list of (bin upper edge, count).
+        '''
+        with self._lock:
+            return {'flush_sizes': dict(self.flush_sizes),
+                    'flush_latency_ms': zip(self.LATENCY_BINS_MS,
+                                            self.flush_latency),
+                    'isolated_failures': self.isolated_failures}
+
+class FeatureCache(object):
+    '''A content addressed cache of the valence vectors returned by Aquila.
+
+    Entries are keyed on a hash of the preprocessed image and the model
+    version. The most recently used entries are kept in memory up to a
+    byte budget. Optionally, every entry is also written as a .npy file to
+    a directory, so that it can be shared between processes and survive
+    restarts. The files are written in a background thread and the least
+    recently used ones are deleted to keep the directory under its own
+    byte budget. That budget is tracked by each process, so processes
+    sharing a directory can together go over it. Call close() to stop the
+    writer thread.
+    '''
+    def __init__(self, max_bytes=64 * 1024 * 1024, disk_dir=None,
+                 max_disk_bytes=1024 * 1024 * 1024):
+        '''
+        max_bytes - Maximum size of the arrays held in memory.
+        disk_dir - Optional directory for the on-disk tier.
+        max_disk_bytes - Maximum size of the files in disk_dir written or
+        found by this process.
+        '''
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        # File name -> size of the files in disk_dir, least recently used
+        # first
+        self._disk_entries = collections.OrderedDict()
+        self._disk_nbytes = 0
+        self._writer = None
+        if disk_dir is not None:
+            if not os.path.isdir(disk_dir):
+                os.makedirs(disk_dir)
+            self._scan_disk()
+            self._writer = concurrent.futures.ThreadPoolExecutor(1)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+
+    def _scan_disk(self):
+        '''Loads the files already in disk_dir, oldest first.'''
+        files = []
+        for fn in os.listdir(self.disk_dir):
+            if not fn.endswith('.npy'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.disk_dir, fn))
+            except OSError:
+                continue
+            files.append((st.st_mtime, fn, st.st_size))
+        for _, fn, size in sorted(files):
+            self._disk_entries[fn] = size
+            self._disk_nbytes += size
+
+    @staticmethod
+    def digest(image_data):
+        '''Returns the hash of the preprocessed image data.'''
+        return hashlib.sha1(image_data).hexdigest()
+
+    @staticmethod
+    def _disk_name(digest, version):
+        return '%s-%s.npy' % (version, digest)
+
+    def _disk_path(self, digest, version):
+        return os.path.join(self.disk_dir, self._disk_name(digest, version))
+
+    def _insert(self, key, valence):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+            if valence.nbytes > self.max_bytes:
+                return
+            self._entries[key] = valence
+            self._nbytes += valence.nbytes
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                self.evictions += 1
+
+    def get(self, digest, version):
+        '''Returns the cached valence vector or None if there isn't one.'''
+        key = (digest, version)
+        with self._lock:
+            valence = self._entries.pop(key, None)
+            if valence is not None:
+                self._entries[key] = valence
+                self.hits += 1
+                return valence
+
+        if self.disk_dir is not None:
+            name = self._disk_name(digest, version)
+            path = self._disk_path(digest, version)
+            try:
+                # Read into memory, so that the entry counts against the
+                # memory budget like any other.
+                valence = np.load(path, allow_pickle=False)
+            except IOError:
+                pass
+            except ValueError as e:
+                _log.warn('Removing bad feature cache file %s: %s' %
+                          (path, e))
+                self._remove_disk_entry(name)
+            else:
+                valence.flags.writeable = False
+                with self._lock:
+                    self.disk_hits += 1
+                    size = self._disk_entries.pop(name, None)
+                    if size is not None:
+                        self._disk_entries[name] = size
+                self._insert(key, valence)
+                return valence
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, digest, version, valence):
+        '''Adds a valence vector to the cache.
+
+        Returns: A concurrent.futures.Future of the write to disk_dir, or
+                 None if there is no disk tier
+        '''
+        valence = np.array(valence)
+        valence.flags.writeable = False
+        self._insert((digest, version), valence)
+
+        with self._lock:
+            writer = self._writer
+            if writer is None:
+                return None
+            return writer.submit(self._write, digest, version, valence)
+
+    def close(self, wait=True):
+        '''Stops the thread writing to disk_dir. Entries put afterwards are
+        only kept in memory.
+
+        Inputs:
+        wait - If True, wait for the pending writes to finish
+        '''
+        with self._lock:
+            writer = self._writer
+            self._writer = None
+        if writer is not None:
+            writer.shutdown(wait=wait)
+
+    def _remove_disk_entry(self, name):
+        '''Deletes a file from disk_dir and forgets it.'''
+        with self._lock:
+            size = self._disk_entries.pop(name, None)
+            if size is not None:
+                self._disk_nbytes -= size
+        try:
+            os.remove(os.path.join(self.disk_dir, name))
+        except OSError:
+            # Another process may have removed it already
+            pass
+
+    def _write(self, digest, version, valence):
+        '''Writes an entry to disk_dir and evicts old files. Runs in the
+        writer thread.'''
+        name = self._disk_name(digest, version)
+        with self._lock:
+            if name in self._disk_entries:
+                return
+        # Write to a temporary file and then move it so that readers
+        # never see a partial file.
+        try:
+            with tempfile.NamedTemporaryFile(dir=self.disk_dir,
+                                             suffix='.tmp',
+                                             delete=False) as f:
+                np.save(f, valence)
+                size = f.tell()
+            os.rename(f.name, os.path.join(self.disk_dir, name))
+        except (IOError, OSError) as e:
+            _log.warn('Could not write to the feature cache at %s: %s' %
+                      (self.disk_dir, e))
+            return
+
+        evicted = []
+        with self._lock:
+            self._disk_entries[name] = size
+            self._disk_nbytes += size
+            while (self._disk_nbytes > self.max_disk_bytes and
+                   len(self._disk_entries) > 1):
+                old_name, old_size = self._disk_entries.popitem(last=False)
+                self._disk_nbytes -= old_size
+                self.disk_evictions += 1
+                evicted.append(old_name)
+        for old_name in evicted:
+            try:
+                os.remove(os.path.join(self.disk_dir, old_name))
+            except OSError:
+                # Another process may have removed it already
+                pass
+
+    def stats(self):
+        '''Returns a dictionary of the cache counters.'''
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._nbytes,
+                'disk_evictions': self.disk_evictions,
+                'disk_entries': len(self._disk_entries),
+                'disk_bytes': self._disk_nbytes
+                }
+
+# Unnormalized DCT-II basis used for the perceptual hash
+_DCT_32 = np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64.)
+
+class NearDuplicateFilter(object):
+    '''Reuses the valence of a recently scored image that looks the same.
+
+    A 64 bit DCT perceptual hash is computed from a 32 x 32 grayscale copy
+    of the preprocessed image. If one of the `window` most recently scored
+    images has a hash within `max_distance` bits, its valence is reused
+    instead of calling the server. This catches consecutive video frames
+    and static intros or slates that are not byte identical.
+    '''
+    def __init__(self, max_distance=4, window=64):
+        '''
+        max_distance - Maximum Hamming distance between hashes for two
+        images to be considered the same.
+        window - Number of recently scored images to compare against.
+        '''
+        self.max_distance = max_distance
+        self._lock = threading.Lock()
+        self._hashes = np.zeros(window, dtype=np.uint64)
+        self._entries = [None] * window # (model_version, valence)
+        self._next = 0
+
+        self.lookups = 0
+        self.saved = 0
+
+    @staticmethod
+    def phash(image_data):
+        '''Returns the perceptual hash of preprocessed image data as a
+        np.uint64.'''
+        img = np.frombuffer(image_data, dtype=np.uint8).reshape(299, 299, 3)
+        img = img.mean(axis=2)
+
+        # Downsample to 32 x 32 by averaging blocks
+        edges = (np.arange(32) * 299) // 32
+        counts = np.diff(np.append(edges, 299))
+        small = np.add.reduceat(np.add.reduceat(img, edges, axis=0),
+                                edges, axis=1)
+        small /= np.outer(counts, counts)
+
+        # Threshold the lowest 8 x 8 frequencies at their median,
+        # ignoring the DC term.
+        low = _DCT_32[:8].dot(small).dot(_DCT_32[:8].T).reshape(-1)
+        bits = low > np.median(low[1:])
+        return np.packbits(bits).view('>u8')[0].astype(np.uint64)
+
+    def get(self, phash, version):
+        '''Returns the valence of a recent near duplicate or None.'''
+        with self._lock:
+            self.lookups += 1
+            dists = np.unpackbits((self._hashes ^ phash).view(np.uint8))
+            dists = dists.reshape(len(self._hashes), 64).sum(axis=1)
+            for idx in np.argsort(dists, kind='mergesort'):
+                if dists[idx] > self.max_distance:
+                    break
+                entry = self._entries[idx]
+                if entry is not None and entry[0] == version:
+                    self.saved += 1
+                    return entry[1]
+        return None
+
+    def put(self, phash, version, valence):
+        '''Records the valence of a scored image.'''
+        with self._lock:
+            self._hashes[self._next] = phash
+            self._entries[self._next] = (version, valence)
+            self._next = (self._next + 1) % len(self._hashes)
+
+    def stats(self):
+        '''Returns a dictionary with the number of lookups and the number
+        of inference calls saved.'''
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'saved': self.saved
+                }
+
+# Dtype of the packed features, as documented in aquila_inference.proto
+_PACKED_FEATURES_DTYPE = '<f4'
+
+def _response_features(response, shape):
+    '''Returns the outputs in an AquilaResponse or AquilaBatchResponse as
+    a float32 array of the given shape.
+
+    The packed features bytes are decoded without a copy, so the array is
+    read only. Servers that predate packed_features only fill valence.
+
+    Raises: ValueError if the outputs don't fit in shape or their dtype
+            isn't a float
+    '''
+    if response.features:
+        # An unset dtype means the documented wire format
+        dtype = str(response.features_dtype) or _PACKED_FEATURES_DTYPE
+        try:
+            dtype = np.dtype(dtype)
+        except TypeError as e:
+            raise ValueError('Bad features_dtype %r: %s' % (dtype, e))
+        if dtype.kind != 'f':
+            raise ValueError('features_dtype %r is not a float' % dtype.str)
+        features = np.frombuffer(response.features, dtype=dtype)
+        features = features.astype(np.float32, copy=False)
+    else:
+        features = np.array(response.valence, dtype=np.float32)
+    return features.reshape(shape)
+
 class DeepnetPredictor(Predictor):
     '''Prediction using the deepnet Aquila (or an arbitrary predictor).
     Note, this does not require you provision a feature generator for
@@ -396,7 +2388,12 @@ class DeepnetPredictor(Predictor):
 
     def __init__(self, concurrency=10, port=9000,
                  aquila_connection=None,
-                 gender=None, age=None):
+                 gender=None, age=None,
+                 prep_executor='thread', prep_workers=None,
+                 feature_cache=None, near_duplicates=None,
+                 packed_features=True, balancing=None,
+                 refresh_interval=30.0, limiter=None, hedging=None,
+                 batch_window=None, batch_max_images=_MAX_BATCH_IMAGES):
         '''
         concurrency - The maximum number of simultaneous requests to
         submit.
@@ -404,6 +2401,36 @@ class DeepnetPredictor(Predictor):
         aquila_connection - An instance (or singleton) of an object
         that supplies the get_ip method, which returns an IP address
         of an Aquila server as a string.
+        gender, age - The demographic to score for, unless the call asks
+        for others.
+        prep_executor - Where images are preprocessed. 'inline' does it
+        on the IOLoop, 'thread' in a thread pool and 'process' in a
+        SharedMemoryPrepPool. Its processes are forked here, so create the
+        predictor before starting other threads.
+        prep_workers - Number of processes if prep_executor is 'process'.
+        feature_cache - Optional FeatureCache used to avoid rescoring
+        images that have been seen before. It is closed by shutdown().
+        near_duplicates - Optional NearDuplicateFilter used to reuse the
+        features of recent images that look the same.
+        packed_features - If True, ask the server to return the features
+        as packed float32 bytes instead of a repeated float.
+        balancing - If set, keep channels to all the servers from
+        aquila_connection.get_ips(), or get_ip() if it doesn't have that,
+        in an AquilaChannelPool and route each call using this policy, one
+        of AquilaChannelPool.POLICIES.
+        Otherwise, use a single server from aquila_connection.get_ip().
+        refresh_interval - Seconds between refreshes of the server list
+        when balancing.
+        limiter - AdaptiveConcurrencyLimiter for the calls to the server.
+        It can be shared between predictors. Defaults to one starting at
+        concurrency calls in flight.
+        hedging - Optional HedgingPolicy. Calls that are slower than its
+        percentile are also sent to another server and the first answer
+        is used. Needs balancing to have another server.
+        batch_window - If set, predict() calls made at about the same time
+        on an IOLoop are sent together in a RegressBatch call by a
+        MicroBatcher, which waits up to this many seconds to fill a batch.
+        batch_max_images - Maximum images in such a batch.
         '''
         super(DeepnetPredictor, self).__init__()
         self.concurrency = concurrency
@@ -411,6 +2438,14 @@ class DeepnetPredictor(Predictor):
         self.port = port
         self._cv = threading.Condition()
         self.active = 0
+        if limiter is None:
+            limiter = AdaptiveConcurrencyLimiter(initial_limit=concurrency)
+        self.limiter = limiter
+        self.hedging = hedging
+        self.batcher = None
+        if batch_window is not None:
+            self.batcher = MicroBatcher(self._send_micro_batch, batch_window,
+                                        batch_max_images)
         self._ready_lock = threading.RLock()
         self._ready = tornado.locks.Event()
         self._shutting_down = False
@@ -422,13 +2457,34 @@ class DeepnetPredictor(Predictor):
         self.channel = None
         self.stub = None
         self._conn_callback = None
+        if (balancing is not None and
+            balancing not in AquilaChannelPool.POLICIES):
+            raise ValueError('Invalid balancing policy: %s' % balancing)
+        self.balancing = balancing
+        self.refresh_interval = refresh_interval
+        self._pool = None
         self._conn_lock = threading.RLock()
         self._consequtive_connection_failures = 0
 
         # Optional demographic parameters used to get the target
         # vector needed when calculating the model score.
-        self.gender = None
-        self.age = None
+        self.gender = gender
+        self.age = age
+
+        self._prep_pool = None
+        if prep_executor not in ('inline', 'thread', 'process'):
+            raise ValueError('Invalid prep_executor: %s' % prep_executor)
+        self.prep_executor = prep_executor
+        if prep_executor == 'process':
+            self._prep_pool = SharedMemoryPrepPool(prep_workers)
+
+        self.feature_cache = feature_cache
+        self.near_duplicates = near_duplicates
+        self.packed_features = packed_features
+        # Maximum number of images to send in one RegressBatch call
+        self.max_batch_images = _MAX_BATCH_IMAGES
+        # The model version of the last response from the server
+        self._model_version = None
 
     def _reconnect(self, force_refresh):
         '''
@@ -439,6 +2495,16 @@ class DeepnetPredictor(Predictor):
 
     def connect(self, force_refresh=False):
         '''Establish a connection to the server if there isn't one.'''
+        if self.balancing is not None:
+            with self._conn_lock:
+                if self._pool is None and not self._shutting_down:
+                    weak_self = weakref.ref(self)
+                    self._pool = AquilaChannelPool(
+                        self.aq_conn, self.port, self.concurrency,
+                        self.balancing, self.refresh_interval,
+                        lambda ready: _pool_ready_callback(weak_self, ready))
+                    self._pool.refresh(force_refresh)
+            return
         with self._conn_lock:
             if self.channel is None and not self._shutting_down:
                 host = self.aq_conn.get_ip(force_refresh=force_refresh)
@@ -460,6 +2526,11 @@ class DeepnetPredictor(Predictor):
         ''' Disconnect from the server if there is a connection. '''
         # the connection has been lost
         with self._conn_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+                with self._ready_lock:
+                    self._ready.clear()
             if self.channel is not None:
                 with self._ready_lock:
                     self._ready.clear()
@@ -491,33 +2562,319 @@ class DeepnetPredictor(Predictor):
             self._consequtive_connection_failures = 0
             _log.debug('Ready event is set.')
 
+    def _start_call(self, method, request, deadline, stub, backend,
+                    start_time):
+        '''Sends a call to the server.
+
+        When the call finishes, its limiter slot and pool backend are given
+        back.
+
+        Returns: The GRPCFutureWrapper of the call
+        '''
+        with self._cv:
+            self.active += 1
+        hedging = self.hedging
+        def _finished(future):
+            # Runs in a gRPC thread
+            if future is None or future.cancelled():
+                self.limiter.cancel()
+            else:
+                failed = future.exception() is not None
+                self.limiter.release(start_time, failed)
+                if not failed and hedging is not None:
+                    hedging.record(time.time() - start_time)
+            self._release_stub(backend)
+            with self._cv:
+                self.active -= 1
+                self._cv.notify_all()
+        try:
+            call = GRPCFutureWrapper(getattr(stub, method).future(
+                request, max(deadline - time.time(), 0.001)))
+        except:
+            _finished(None)
+            raise
+        call.add_done_callback(_finished)
+        return call
+
+    def _start_hedge(self, method, request, deadline, backend):
+        '''Sends a duplicate of a slow call to a different server if one is
+        ready, the limiter has a free slot and the hedging budget allows.
+
+        Returns: The GRPCFutureWrapper of the hedge, or None
+        '''
+        pool = self._pool
+        if pool is None or self._shutting_down:
+            return None
+        start_time = self.limiter.try_acquire()
+        if start_time is None:
+            return None
+        other = pool.acquire(exclude=backend)
+        if other is None:
+            self.limiter.cancel()
+            return None
+        if not self.hedging.try_hedge():
+            pool.release(other)
+            self.limiter.cancel()
+            return None
+        try:
+            return self._start_call(method, request, deadline, other.stub,
+                                    other, start_time)
+        except Exception as e:
+            _log.warn('Could not send a hedged call: %s' % e)
+            return None
+
+    def _pool_ready(self, ready):
+        '''Called when the pool goes from no server being ready to some
+        being ready, or back.'''
+        with self._ready_lock:
+            if ready:
+                self._ready.set()
+            else:
+                self._ready.clear()
+
+    def _get_stub(self):
+        '''Returns the (stub, pool backend or None) to make a call with.
+
+        Raises: PredictionError if there isn't a server to call
+        '''
+        if self._pool is not None:
+            backend = self._pool.acquire()
+            if backend is None:
+                raise PredictionError('No Aquila server is ready')
+            return backend.stub, backend
+        if self.stub is None:
+            raise PredictionError('Not connected to a server.')
+        return self.stub, None
+
+    def _release_stub(self, backend):
+        '''Marks a call using a stub from _get_stub as done.'''
+        pool = self._pool
+        if backend is not None and pool is not None:
+            pool.release(backend)
+
+    def _prep_image(self, image):
+        '''Returns a Future of the preprocessed image data to send.'''
+        if self.prep_executor == 'process':
+            return self._prep_pool.submit(image)
+        elif self.prep_executor == 'thread':
+            return self._executor.submit(_prep_request_data, image)
+        return tornado.gen.maybe_future(_prep_request_data(image))
+
     @tornado.gen.coroutine
-    def _predict(self, image, timeout=10.0):
+    def _predict(self, image, timeout=10.0, demographics=None):
         '''
         image: The image to be scored, as a OpenCV-style numpy array.
         timeout: How long the request lasts for before expiring.
+        demographics: Optional list of (gender, age) tuples, or 'all', to
+                      score for. If set, the score is an array with one
+                      score per demographic instead of the score for
+                      self.gender and self.age.
         '''
         if self._shutting_down:
             raise PredictionError('Object is shutting down.')
 
+        request = aquila_inference_pb2.AquilaRequest()
+        request.packed_features = self.packed_features
+        request.image_data = yield self._prep_image(image)
+
+        digest = None
+        if self.feature_cache is not None:
+            digest = FeatureCache.digest(request.image_data)
+            vers = self._model_version
+            if vers is not None:
+                valence = self.feature_cache.get(digest, vers)
+                if valence is not None:
+                    signatures = yield self._get_signatures(valence, vers)
+                    raise tornado.gen.Return(self._score_valence(
+                        valence, vers, signatures, demographics))
+
+        phash = None
+        if self.near_duplicates is not None:
+            phash = NearDuplicateFilter.phash(request.image_data)
+            vers = self._model_version
+            if vers is not None:
+                valence = self.near_duplicates.get(phash, vers)
+                if valence is not None:
+                    signatures = yield self._get_signatures(valence, vers)
+                    raise tornado.gen.Return(self._score_valence(
+                        valence, vers, signatures, demographics))
+
         # Wait for the connection to be ready
         with self._ready_lock:
             ready_future = self._ready.wait(datetime.timedelta(seconds=timeout))
         yield ready_future
-        
-        image = _aquila_prep(image)
-        request = aquila_inference_pb2.AquilaRequest()
-        request.image_data = image.flatten().tostring()
-        # # it appears to be the case that creating the stub as an
-        # # attribute can cause some issues, so let's see if this
-        # # works.
-        # with aquila_inference_pb2.beta_create_AquilaService_stub(self.channel) as stub:
-        #     result_future = stub.Regress.future(request, timeout)  # 10 second timeout
+
+        if self.batcher is not None:
+            valence, vers = yield self.batcher.submit(request.image_data,
+                                                      timeout)
+        else:
+            response = yield self._rpc('Regress', request, timeout)
+            vers = response.model_version or 'aqv1.1.250'
+            try:
+                valence = _response_features(response, (-1,))
+            except ValueError as e:
+                msg = 'RPC Error: malformed response: %s' % e
+                _log.error(msg)
+                raise PredictionError(msg)
+        self._model_version = vers
+
+        if digest is not None:
+            self.feature_cache.put(digest, vers, valence)
+        if phash is not None:
+            self.near_duplicates.put(phash, vers, valence)
+        signatures = yield self._get_signatures(valence, vers)
+        raise tornado.gen.Return(
+            self._score_valence(valence, vers, signatures, demographics))
+
+    @tornado.gen.coroutine
+    def _predict_batch(self, images, timeout=10.0, demographics=None):
+        '''
+        images: The images to be scored, as a list of OpenCV-style numpy
+                arrays.
+        timeout: How long the request lasts for before expiring.
+        demographics: Optional list of (gender, age) tuples, or 'all', to
+                      score for. If set, the scores are N x D.
+        '''
+        if self._shutting_down:
+            raise PredictionError('Object is shutting down.')
+
+        if len(images) == 0:
+            if demographics is None:
+                scores = np.empty((0,), dtype=np.float32)
+            else:
+                ndemos = (len(DEMOGRAPHICS) if demographics == 'all'
+                          else len(demographics))
+                scores = np.empty((0, ndemos), dtype=np.float32)
+            raise tornado.gen.Return(
+                (scores, np.empty((0, 0), dtype=np.float32), None))
+
+        # Split the images into requests that fit in a gRPC message
+        step = self.max_batch_images
+        requests = yield [self._prep_batch_request(images[i:i + step])
+                          for i in range(0, len(images), step)]
+
+        # Wait for the connection to be ready
+        with self._ready_lock:
+            ready_future = self._ready.wait(datetime.timedelta(seconds=timeout))
+        yield ready_future
+
+        responses = yield [self._rpc('RegressBatch', request, timeout)
+                           for request in requests]
+
+        valence = np.vstack([
+            self._batch_features(request, response, responses[0].num_features)
+            for request, response in zip(requests, responses)])
+
+        vers = responses[0].model_version or 'aqv1.1.250'
+        self._model_version = vers
+
+        signatures = yield self._get_signatures(valence, vers)
+        raise tornado.gen.Return(self._score_valence_batch(
+            valence, vers, signatures, demographics))
+
+    def _batch_features(self, request, response, num_features=None):
+        '''Returns the N x F outputs in a RegressBatch response.
+
+        Raises: PredictionError if the response doesn't match the request
+        '''
+        try:
+            if (response.num_images != request.num_images or
+                (num_features is not None and
+                 response.num_features != num_features)):
+                raise ValueError('wrong number of outputs')
+            return _response_features(
+                response, (response.num_images, response.num_features))
+        except ValueError as e:
+            msg = 'RPC Error: malformed batch response: %s' % e
+            _log.error(msg)
+            raise PredictionError(msg)
+
+    @tornado.gen.coroutine
+    def _send_micro_batch(self, image_datas, timeout):
+        '''Sends the images collected by the MicroBatcher.
+
+        Returns: (N x F outputs, model version)
+        '''
+        request = aquila_inference_pb2.AquilaBatchRequest()
+        request.packed_features = self.packed_features
+        request.num_images = len(image_datas)
+        request.image_data = b''.join(image_datas)
+        response = yield self._rpc('RegressBatch', request, timeout)
+        raise tornado.gen.Return((self._batch_features(request, response),
+                                  response.model_version or 'aqv1.1.250'))
+
+    def predict_stream(self, images, window=32, timeout=3600.0,
+                       demographics=None):
+        '''Scores a stream of images over a single RegressStream call.
+
+        This is a generator that consumes images lazily and yields the
+        results in the same order. At most `window` images are sent ahead
+        of the results that have been consumed, so a slow consumer holds
+        back the producer.
+
+        Inputs:
+        images - iterable of OpenCV-style numpy arrays, e.g. video frames
+        window - maximum number of images in flight
+        timeout - deadline, in seconds, for the whole stream
+        demographics - Optional list of (gender, age) tuples, or 'all', to
+                       score each image for
+
+        Yields: (predicted valence score, feature vector, model_version)
+                for each image
+
+        Raises: PredictionError if the stream fails
+        '''
+        if self._shutting_down:
+            raise PredictionError('Object is shutting down.')
+        start_time = self._wait_for_stream(timeout)
+        try:
+            stub, backend = self._get_stub()
+        except:
+            self.limiter.cancel()
+            raise
+
+        in_flight = threading.Semaphore(window)
+        def _requests():
+            # This is run by gRPC in its own thread
+            for image in images:
+                in_flight.acquire()
+                request = aquila_inference_pb2.AquilaRequest()
+                request.packed_features = self.packed_features
+                if self.prep_executor == 'process':
+                    request.image_data = self._prep_pool.submit(image).result()
+                else:
+                    request.image_data = _prep_request_data(image)
+                yield request
+
         with self._cv:
             self.active += 1
+        responses = None
+        failed = True
         try:
-            response = yield GRPCFutureWrapper(self.stub.Regress.future(
-                request, timeout))
+            responses = stub.RegressStream(_requests(), timeout)
+            for response in responses:
+                in_flight.release()
+                vers = response.model_version or 'aqv1.1.250'
+                self._model_version = vers
+                valence = _response_features(response, (-1,))
+                # This is a synchronous API, so wait for the signatures
+                # here if they are still loading.
+                signatures = None
+                if len(valence) > 1:
+                    try:
+                        signatures = DemographicSignatures.prefetch(
+                            vers).result()
+                    except KeyError:
+                        pass
+                yield self._score_valence(valence, vers, signatures,
+                                          demographics)
+            failed = False
+        except GeneratorExit:
+            # The consumer stopped early
+            failed = False
+            raise
+        except PredictionError:
+            raise
         # TODO(mdesnoyer, nick): On upgrade, only catch
         # RpcErrors. Version 0.13 of grpc doesn't have them
         except Exception as e:
@@ -525,34 +2882,210 @@ class DeepnetPredictor(Predictor):
             _log.error(msg)
             raise PredictionError(msg)
         finally:
+            if responses is not None:
+                # Stops the stream if the consumer stopped early
+                responses.cancel()
+            # The length of a stream says nothing about the server's queue,
+            # so only a failure adjusts the limit.
+            if failed:
+                self.limiter.release(start_time, failed=True)
+            else:
+                self.limiter.cancel()
+            self._release_stub(backend)
             with self._cv:
                 self.active -= 1
                 self._cv.notify_all()
 
+    @utils.sync.optional_sync
+    @tornado.gen.coroutine
+    def _wait_for_stream(self, timeout):
+        '''Waits for the connection to be ready and then for a limiter slot
+        for a stream. The whole stream uses the one slot.
+
+        Returns: The start time of the slot, to pass to the limiter
+
+        Raises: PredictionError if either takes longer than timeout
+        '''
+        deadline = time.time() + timeout
+        with self._ready_lock:
+            ready_future = self._ready.wait(datetime.timedelta(seconds=timeout))
+        try:
+            yield ready_future
+        except tornado.gen.TimeoutError:
+            raise PredictionError('No server was ready after %gs' % timeout)
+        start_time = yield self.limiter.acquire(
+            max(deadline - time.time(), 0.0))
+        raise tornado.gen.Return(start_time)
+
+    @tornado.gen.coroutine
+    def _prep_batch_request(self, images):
+        '''Builds the AquilaBatchRequest for a list of images.'''
+        request = aquila_inference_pb2.AquilaBatchRequest()
+        request.packed_features = self.packed_features
+        request.num_images = len(images)
+        if self.prep_executor == 'inline':
+            request.image_data = _prep_batch_data(images)
+        elif self.prep_executor == 'process':
+            image_datas = yield [self._prep_pool.submit(x) for x in images]
+            request.image_data = b''.join(image_datas)
+        else:
+            request.image_data = yield self._executor.submit(_prep_batch_data,
+                                                             images)
+        raise tornado.gen.Return(request)
+
+    @tornado.gen.coroutine
+    def _rpc(self, method, request, timeout):
+        '''Calls a method on the server.
+
+        Returns: The response
+
+        Raises: PredictionError if the call fails
+        '''
+        # # it appears to be the case that creating the stub as an
+        # # attribute can cause some issues, so let's see if this
+        # # works.
+        # with aquila_inference_pb2.beta_create_AquilaService_stub(self.channel) as stub:
+        #     result_future = stub.Regress.future(request, timeout)  # 10 second timeout
+        deadline = time.time() + timeout
+        start_time = yield self.limiter.acquire(timeout)
+        try:
+            stub, backend = self._get_stub()
+        except:
+            self.limiter.cancel()
+            raise
+
+        io_loop = tornado.ioloop.IOLoop.current()
+        result = tornado.concurrent.Future()
+        calls = []
+        def _done(call):
+            # Runs on the IOLoop. The first success is the result.
+            if result.done():
+                return
+            if not call.cancelled() and call.exception() is None:
+                result.set_result((call, call.result()))
+            elif all(x.done() for x in calls):
+                result.set_exception(
+                    PredictionError('Call was cancelled') if call.cancelled()
+                    else call.exception())
+        def _add_call(call):
+            calls.append(call)
+            call.add_done_callback(
+                lambda f: io_loop.add_callback(_done, call))
+
+        def _hedge():
+            if result.done():
+                return
+            call = self._start_hedge(method, request, deadline, backend)
+            if call is not None:
+                _add_call(call)
+
+        hedge_timeout = None
+        try:
+            _add_call(self._start_call(method, request, deadline, stub,
+                                       backend, start_time))
+            delay = (None if self.hedging is None or self._pool is None
+                     else self.hedging.hedge_delay())
+            if delay is not None and time.time() + delay < deadline:
+                hedge_timeout = io_loop.call_later(delay, _hedge)
+            call, response = yield result
+            if call is not calls[0]:
+                self.hedging.record_win()
+        # TODO(mdesnoyer, nick): On upgrade, only catch
+        # RpcErrors. Version 0.13 of grpc doesn't have them
+        except Exception as e:
+            msg = 'RPC Error: %s' % e
+            _log.error(msg)
+            raise PredictionError(msg)
+        finally:
+            if hedge_timeout is not None:
+                io_loop.remove_timeout(hedge_timeout)
+            # Stop the call that lost
+            for call in calls:
+                if not call.done():
+                    call.cancel()
+
         if response is None:
             msg = 'RPC Error: response was None'
             _log.error(msg)
             raise PredictionError(msg)
+        raise tornado.gen.Return(response)
+
+    def warm_up(self, model_versions):
+        '''Starts loading the demographic signatures for model versions in
+        the background, so that the first predictions from them don't wait.
+
+        Returns: A list of concurrent.futures.Future, one per version
+        '''
+        return [DemographicSignatures.prefetch(x) for x in model_versions]
+
+    @tornado.gen.coroutine
+    def _get_signatures(self, valence, vers):
+        '''Returns the DemographicSignatures needed to score valence.
+
+        If they aren't loaded yet, they are loaded in the background, so
+        the IOLoop isn't blocked. Returns None if they aren't needed or
+        can't be loaded.
+        '''
+        if valence.shape[-1] == 1:
+            raise tornado.gen.Return(None)
+        signatures = DemographicSignatures.get_loaded(vers)
+        if signatures is None:
+            try:
+                signatures = yield DemographicSignatures.prefetch(vers)
+            except KeyError:
+                pass
+        raise tornado.gen.Return(signatures)
 
-        vers = response.model_version or 'aqv1.1.250'
+    def _score_valence(self, valence, vers, signatures, demographics=None):
+        '''Converts the valence returned by the server to
+        (score, features, model_version) using the DemographicSignatures
+        from _get_signatures.
 
-        if len(response.valence) == 1:
+        If demographics is set, score is an array of the scores for them.
+        '''
+        if len(valence) == 1:
             # The response is only returning the valence, not the
             # feature vector
-            raise tornado.gen.Return((response.valence[0], None, vers))
+            return (valence[0], None, vers)
 
-        features = np.array(response.valence)
+        features = valence
         score = None
-        if response.model_version is not None:
-            try:
-                signatures = DemographicSignatures(response.model_version)
+        try:
+            if signatures is None:
+                raise KeyError(vers)
+            if demographics is None:
                 score = signatures.compute_score_for_demo(
                     features, gender=self.gender, age=self.age)
-            except KeyError as e:
-                # There was some problem obtaining the score.
-                _log.warn_n('Unknown model/demographic. model: %s age: %s gender %s'
-                            % (response.model_version, self.gender, self.age))
-        raise tornado.gen.Return((score, features, vers))
+            else:
+                score = signatures.compute_scores_for_demos(features,
+                                                            demographics)
+        except KeyError as e:
+            # There was some problem obtaining the score.
+            _log.warn_n('Unknown model/demographic. model: %s age: %s gender %s'
+                        % (vers, self.gender, self.age))
+        return (score, features, vers)
+
+    def _score_valence_batch(self, valence, vers, signatures,
+                             demographics=None):
+        '''Converts the N x D valence block returned by the server to
+        (scores, features, model_version).'''
+        if valence.shape[1] == 1:
+            return (valence[:, 0], None, vers)
+
+        scores = None
+        try:
+            if signatures is None:
+                raise KeyError(vers)
+            if demographics is None:
+                scores = signatures.compute_scores_for_demo(
+                    valence, gender=self.gender, age=self.age)
+            else:
+                scores = signatures.compute_scores_for_demos(valence,
+                                                             demographics)
+        except KeyError as e:
+            _log.warn_n('Unknown model/demographic. model: %s age: %s gender %s'
+                        % (vers, self.gender, self.age))
+        return (scores, valence, vers)
 
     def complete(self):
         '''
@@ -571,6 +3104,11 @@ class DeepnetPredictor(Predictor):
         _log.debug('Exit has started.')
         self._shutting_down = True
         self._disconnect()
+        if self._prep_pool is not None:
+            self._prep_pool.shutdown(wait=False)
+            self._prep_pool = None
+        if self.feature_cache is not None:
+            self.feature_cache.close(wait=False)
 
 # -------------- Start Exception Definitions --------------#
 
@@ -588,3 +3126,6 @@ class AlreadyTrainedError(Error):
 
 class PredictionError(Error):
     '''An error calculating the prediction.'''
+
+class ConcurrencyLimitError(PredictionError):
+    '''Too many calls are waiting for the server.'''
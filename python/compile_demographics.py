@@ -0,0 +1,101 @@
+'''
+Compiles the demographic signature pickles of models into the memory
+mapped format that DemographicSignatures prefers to load.
+
+For each model, demographics/<model>-weight.pkl and <model>-bias.pkl are
+converted to <model>-signatures.npy and <model>-signatures.json. Rerun
+this whenever the pickles change.
+
+With --pca, the PCA that the exported model applies to the abstract
+features is also folded into the signatures, giving a <model>-raw model
+that scores the raw abstract features directly.
+
+To run it:
+python compile_demographics.py 20160713-aquilav2 [--pca pca.pkl]
+
+Copyright: 2016 Neon Labs
+'''
+import argparse
+import client
+import logging
+import numpy as np
+
+_log = logging.getLogger(__name__)
+
+def check(model_name, directory=None):
+    '''Checks that the compiled signatures score like the pickles.
+
+    Returns: The largest absolute difference in score on random features
+    '''
+    compiled = client.DemographicSignatures.__new__(
+        client.DemographicSignatures)
+    compiled._load_compiled(model_name, directory)
+    pickled = client.DemographicSignatures.__new__(
+        client.DemographicSignatures)
+    pickled._load_pickles(model_name, directory)
+
+    X = np.tanh(np.random.RandomState(0).randn(
+        100, pickled._signatures.shape[1]))
+    diff = 0.0
+    for key, i in pickled._columns.iteritems():
+        j = compiled._columns[key]
+        diff = max(diff, np.max(np.abs(
+            X.dot(compiled._signatures[j]) + compiled._bias[j] -
+            X.dot(pickled._weights[key].values) -
+            float(pickled._bias_frame[key]))))
+    return diff
+
+def check_folded(model_name, pca, folded_name=None, directory=None):
+    '''Checks that the folded signatures score raw features like applying
+    the PCA and then the signatures.
+
+    Returns: The largest absolute difference in score on random features
+    '''
+    components, mean = client._pca_params(pca)
+    folded = client.DemographicSignatures.__new__(
+        client.DemographicSignatures)
+    folded._load_compiled(folded_name or '%s-raw' % model_name, directory)
+    pickled = client.DemographicSignatures.__new__(
+        client.DemographicSignatures)
+    pickled._load_pickles(model_name, directory)
+
+    X = mean + np.random.RandomState(0).randn(100, components.shape[1])
+    pca_feats = (X - mean).dot(components.T)
+    diff = 0.0
+    for key, i in pickled._columns.iteritems():
+        j = folded._columns[key]
+        diff = max(diff, np.max(np.abs(
+            X.dot(folded._signatures[j]) + folded._bias[j] -
+            pca_feats.dot(pickled._weights[key].values) -
+            float(pickled._bias_frame[key]))))
+    return diff
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('models', nargs='+',
+                        help='Names of the models to compile')
+    parser.add_argument('--directory', default=None,
+                        help='Directory with the pickles. Defaults to '
+                        'demographics/')
+    parser.add_argument('--pca', default=None,
+                        help='sklearn PCA, saved with joblib, to fold into '
+                        'the signatures')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for model_name in args.models:
+        npy_fn, json_fn = client.compile_signatures(model_name,
+                                                    args.directory)
+        _log.info('Wrote %s and %s, max score difference %g' %
+                  (npy_fn, json_fn, check(model_name, args.directory)))
+        if args.pca is not None:
+            npy_fn, json_fn = client.fold_pca_signatures(
+                model_name, args.pca, directory=args.directory)
+            _log.info('Wrote %s and %s, max score difference from the two '
+                      'step path %g' %
+                      (npy_fn, json_fn,
+                       check_folded(model_name, args.pca,
+                                    directory=args.directory)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''
+A pure Python stand in for the Aquila inference server.
+
+It implements the AquilaService protocol, but replaces the network with a
+fixed random projection of the image, so that the client can be run and
+benchmarked without the TensorFlow Serving build. The outputs are
+deterministic, but are not meaningful features.
+
+To run it:
+python local_server.py --port 9000
+
+Copyright: 2016 Neon Labs
+'''
+import aquila_inference_pb2
+import argparse
+from grpc.beta import interfaces as beta_interfaces
+import logging
+import numpy as np
+import time
+
+_log = logging.getLogger(__name__)
+
+# Size of a preprocessed image in bytes
+_IMAGE_SIZE = 299 * 299 * 3
+
+class StaticConnection(object):
+    '''An aquila_connection for DeepnetPredictor that always returns the
+    same hosts.'''
+    def __init__(self, host='localhost'):
+        '''
+        host - The host, or a list of hosts. Hosts can be host:port.
+        '''
+        if isinstance(host, basestring):
+            host = [host]
+        self.hosts = list(host)
+
+    def get_ip(self, force_refresh=False):
+        return self.hosts[0]
+
+    def get_ips(self, force_refresh=False):
+        return list(self.hosts)
+
+class LocalAquilaServicer(aquila_inference_pb2.BetaAquilaServiceServicer):
+    '''Serves the AquilaService using a stand in for the model.'''
+    def __init__(self, num_features=1024, model_version='20160713-aquilav2',
+                 delay=0.0, seed=0):
+        '''
+        num_features - The size of the feature vector to return.
+        model_version - The model version to put in the responses.
+        delay - Seconds to wait before answering each call, to mimic the
+                time spent in the network.
+        seed - Seed for the projection.
+        '''
+        self.model_version = model_version
+        self.delay = delay
+        # The images are average pooled in 13 x 13 blocks to 23 x 23 x 3
+        # and then projected.
+        rs = np.random.RandomState(seed)
+        self._projection = (rs.randn(23 * 23 * 3, num_features) /
+                            np.sqrt(23 * 23 * 3)).astype(np.float32)
+
+    def regress(self, image_data, num_images):
+        '''Returns the num_images x num_features outputs for a block of
+        preprocessed images.'''
+        images = np.frombuffer(image_data, dtype=np.uint8)
+        images = images.reshape(num_images, 23, 13, 23, 13, 3)
+        pooled = images.mean(axis=(2, 4), dtype=np.float32)
+        pooled = (pooled.reshape(num_images, -1) - 128.) / 64.
+        return np.tanh(pooled.dot(self._projection))
+
+    def _fill(self, response, valence, packed):
+        '''Puts the outputs in a response, packed if asked for.'''
+        if packed:
+            response.features = valence.astype('<f4').tostring()
+            response.features_dtype = '<f4'
+            response.features_shape.extend(valence.shape)
+        else:
+            response.valence.extend(valence.reshape(-1))
+        response.model_version = self.model_version
+
+    def _invalid(self, context, msg):
+        _log.warn(msg)
+        context.code(beta_interfaces.StatusCode.INVALID_ARGUMENT)
+        context.details(msg)
+
+    def Regress(self, request, context):
+        response = aquila_inference_pb2.AquilaResponse()
+        if len(request.image_data) != _IMAGE_SIZE:
+            self._invalid(context, 'image_data must be a 299 x 299 x 3 image')
+            return response
+        time.sleep(self.delay)
+        self._fill(response, self.regress(request.image_data, 1)[0],
+                   request.packed_features)
+        return response
+
+    def RegressBatch(self, request, context):
+        response = aquila_inference_pb2.AquilaBatchResponse()
+        if (request.num_images <= 0 or
+            len(request.image_data) != request.num_images * _IMAGE_SIZE):
+            self._invalid(context,
+                          'image_data must hold num_images 299 x 299 x 3 '
+                          'images')
+            return response
+        time.sleep(self.delay)
+        valence = self.regress(request.image_data, request.num_images)
+        self._fill(response, valence, request.packed_features)
+        response.num_images, response.num_features = valence.shape
+        return response
+
+    def RegressStream(self, request_iterator, context):
+        for request in request_iterator:
+            response = self.Regress(request, context)
+            if len(request.image_data) != _IMAGE_SIZE:
+                return
+            yield response
+
+def serve(port, servicer=None, pool_size=None):
+    '''Starts serving on a port.
+
+    Returns: The started server. Call stop() on it to shut it down.
+    '''
+    if servicer is None:
+        servicer = LocalAquilaServicer()
+    server = aquila_inference_pb2.beta_create_AquilaService_server(
+        servicer, pool_size=pool_size)
+    server.add_insecure_port('[::]:%d' % port)
+    server.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=9000,
+                        help='Port to serve on')
+    parser.add_argument('--delay', type=float, default=0.0,
+                        help='Seconds to wait before answering each call')
+    parser.add_argument('--model_version', default='20160713-aquilav2',
+                        help='Model version to put in the responses')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = serve(args.port, LocalAquilaServicer(
+        model_version=args.model_version, delay=args.delay))
+    _log.info('Serving on port %d' % args.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop(0)
+
+if __name__ == '__main__':
+    main()
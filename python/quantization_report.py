@@ -0,0 +1,77 @@
+'''
+Reports the accuracy lost by storing feature vectors as QuantizedFeatures.
+
+The features are scored for every demographic with a model's signatures,
+both as float32 and from each quantized form, and the differences are
+reported along with the storage per vector. The ranking agreement is the
+fraction of the top candidates per demographic that are the same.
+
+Features are read from an N x F .npy file of stored vectors, or if none
+is given, drawn from a Gaussian whose variances fall off like those of
+PCA features.
+
+To run it:
+python quantization_report.py --features archive.npy
+
+Copyright: 2016 Neon Labs
+'''
+import argparse
+import client
+import numpy as np
+
+def synthetic_features(n, num_features, seed=0):
+    '''Returns n x num_features Gaussian features with a decaying variance
+    spectrum.'''
+    rs = np.random.RandomState(seed)
+    std = 1. / np.sqrt(1. + np.arange(num_features) / 8.)
+    return (rs.randn(n, num_features) * std).astype(np.float32)
+
+def report(X, model_name, k=10):
+    '''Returns a list of (dtype, bytes per vector, max abs error, mean abs
+    error, 99th percentile abs error, top k agreement).'''
+    signatures = client.DemographicSignatures(model_name)
+    reference = signatures.get_scores_for_all_demos_batch(X)
+    ref_top = client.top_k(reference, k)
+
+    rows = [('float32', X.shape[1] * 4, 0., 0., 0., 1.)]
+    for dtype in client.QuantizedFeatures.DTYPES:
+        quantized = client.QuantizedFeatures.encode(X, dtype)
+        scores = signatures.get_scores_for_all_demos_batch(quantized)
+        err = np.abs(scores - reference)
+        top = client.top_k(scores, k)
+        agreement = np.mean([len(np.intersect1d(top[:, j], ref_top[:, j])) /
+                             float(ref_top.shape[0])
+                             for j in range(reference.shape[1])])
+        rows.append((dtype, quantized.nbytes / float(len(quantized)),
+                     err.max(), err.mean(), np.percentile(err, 99),
+                     agreement))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--features', default=None,
+                        help='N x F .npy file of feature vectors')
+    parser.add_argument('--num', type=int, default=10000,
+                        help='Number of synthetic vectors')
+    parser.add_argument('--model_version', default='20160713-aquilav2',
+                        help='Model whose signatures are used')
+    parser.add_argument('--k', type=int, default=10,
+                        help='Number of top candidates to compare')
+    args = parser.parse_args()
+
+    if args.features is not None:
+        X = np.load(args.features, mmap_mode='r')
+    else:
+        X = synthetic_features(args.num, 1024)
+    reference = client.DemographicSignatures(
+        args.model_version).get_scores_for_all_demos_batch(X)
+
+    print '%d vectors, score std %.4f' % (X.shape[0], reference.std())
+    print '%-8s %10s %10s %10s %10s %10s' % (
+        'dtype', 'bytes/vec', 'max err', 'mean err', 'p99 err',
+        'top%d agree' % args.k)
+    for row in report(X, args.model_version, args.k):
+        print '%-8s %10.1f %10.2e %10.2e %10.2e %10.3f' % row
+
+if __name__ == '__main__':
+    main()
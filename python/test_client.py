@@ -0,0 +1,735 @@
+'''
+Tests for the Aquila client.
+
+They run against the pure Python stand in from local_server.py, so they
+don't need the TensorFlow Serving build.
+
+To run them:
+python -m unittest test_client
+
+Copyright: 2016 Neon Labs
+'''
+import aquila_inference_pb2
+import client
+import concurrent.futures
+import local_server
+import numpy as np
+import os
+import pandas
+import shutil
+import tempfile
+import threading
+import time
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import unittest
+import utils.sync
+
+class TestAdaptiveConcurrencyLimiter(unittest.TestCase):
+    def _fill(self, limiter):
+        '''Takes every free slot.'''
+        while limiter.try_acquire() is not None:
+            pass
+
+    def _run(self, limiter, rtt, calls):
+        '''Keeps the limiter full with calls that take rtt seconds.'''
+        for i in range(calls):
+            self._fill(limiter)
+            limiter.release(time.time() - rtt)
+
+    def test_adapts_to_latency(self):
+        limiter = client.AdaptiveConcurrencyLimiter(initial_limit=20)
+        self._run(limiter, 0.01, 50)
+        self.assertGreater(limiter.limit, 20)
+
+        # With 5 times the lowest latency, 80% of the calls are estimated
+        # to be queued, so the limit shrinks until that is under beta.
+        self._run(limiter, 0.05, 100)
+        self.assertLessEqual(limiter.limit, 8)
+        self.assertGreaterEqual(limiter.limit, limiter.min_limit)
+
+        self._run(limiter, 0.01, 20)
+        self.assertGreater(limiter.limit, 20)
+
+    def test_failures_back_off(self):
+        limiter = client.AdaptiveConcurrencyLimiter(initial_limit=10,
+                                                    min_limit=5)
+        for i in range(10):
+            limiter.release(limiter.try_acquire(), failed=True)
+        self.assertEqual(limiter.limit, 5)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_waiters_get_slots_in_order(self):
+        limiter = client.AdaptiveConcurrencyLimiter(initial_limit=1)
+        order = []
+
+        @tornado.gen.coroutine
+        def _call(i):
+            yield limiter.acquire()
+            order.append(i)
+            yield tornado.gen.moment
+            limiter.cancel()
+
+        @tornado.gen.coroutine
+        def _calls():
+            yield [_call(i) for i in range(5)]
+        tornado.ioloop.IOLoop.current().run_sync(_calls)
+
+        self.assertEqual(order, range(5))
+        self.assertEqual(limiter.in_flight, 0)
+        self.assertEqual(limiter.queue_depth, 0)
+
+    def test_rejects_when_queue_is_full_or_times_out(self):
+        limiter = client.AdaptiveConcurrencyLimiter(initial_limit=1,
+                                                    max_queue=1)
+        limiter.try_acquire()
+
+        @tornado.gen.coroutine
+        def _calls():
+            waiting = limiter.acquire(timeout=0.05)
+            with self.assertRaises(client.ConcurrencyLimitError):
+                yield limiter.acquire()
+            with self.assertRaises(client.ConcurrencyLimitError):
+                yield waiting
+        tornado.ioloop.IOLoop.current().run_sync(_calls)
+
+        self.assertEqual(limiter.rejections, 2)
+        self.assertEqual(limiter.queue_depth, 0)
+        self.assertEqual(limiter.in_flight, 1)
+
+class _FakeBackend(object):
+    '''A pool backend whose Regress calls answer after a delay, or never
+    if the delay is None.'''
+    def __init__(self, delay, response):
+        self.delay = delay
+        self.response = response
+        self.outstanding = 0
+        self.calls = []
+        self.stub = self
+        self.Regress = self
+
+    def future(self, request, timeout):
+        call = concurrent.futures.Future()
+        self.calls.append(call)
+        if self.delay is not None:
+            def _answer():
+                if call.set_running_or_notify_cancel():
+                    call.set_result(self.response)
+            threading.Timer(self.delay, _answer).start()
+        return call
+
+class _FakePool(object):
+    '''Hands out the backends in order.'''
+    def __init__(self, backends):
+        self.backends = backends
+
+    def acquire(self, exclude=None):
+        for backend in self.backends:
+            if backend is not exclude:
+                backend.outstanding += 1
+                return backend
+        return None
+
+    def release(self, backend):
+        backend.outstanding -= 1
+
+    def close(self):
+        pass
+
+class TestHedging(unittest.TestCase):
+    def setUp(self):
+        # Hedges calls that take more than 10ms
+        self.hedging = client.HedgingPolicy(percentile=50.0, budget=1.0,
+                                            window=20, min_samples=1)
+        self.hedging.record(0.01)
+        self.predictor = client.DeepnetPredictor(
+            aquila_connection=local_server.StaticConnection(),
+            balancing='least_outstanding', hedging=self.hedging)
+
+    def tearDown(self):
+        self.predictor.shutdown()
+
+    def _call(self, primary, hedge):
+        self.predictor._pool = _FakePool([primary, hedge])
+        request = aquila_inference_pb2.AquilaRequest()
+        return tornado.ioloop.IOLoop.current().run_sync(
+            lambda: self.predictor._rpc('Regress', request, 5.0))
+
+    def _assert_released(self, *backends):
+        self.assertEqual(self.predictor.limiter.in_flight, 0)
+        self.assertEqual(self.predictor.active, 0)
+        for backend in backends:
+            self.assertEqual(backend.outstanding, 0)
+
+    def test_hedge_is_cancelled_when_primary_wins(self):
+        primary = _FakeBackend(0.1, 'primary')
+        hedge = _FakeBackend(None, 'hedge')
+        self.assertEqual(self._call(primary, hedge), 'primary')
+
+        self.assertEqual(len(hedge.calls), 1)
+        self.assertTrue(hedge.calls[0].cancelled())
+        self.assertEqual(self.hedging.hedges, 1)
+        self.assertEqual(self.hedging.wins, 0)
+        self._assert_released(primary, hedge)
+
+    def test_primary_is_cancelled_when_hedge_wins(self):
+        primary = _FakeBackend(None, 'primary')
+        hedge = _FakeBackend(0.05, 'hedge')
+        self.assertEqual(self._call(primary, hedge), 'hedge')
+
+        self.assertTrue(primary.calls[0].cancelled())
+        self.assertEqual(self.hedging.wins, 1)
+        self._assert_released(primary, hedge)
+
+    def test_no_hedge_without_budget(self):
+        self.hedging.budget = 0.0
+        primary = _FakeBackend(0.05, 'primary')
+        hedge = _FakeBackend(0.0, 'hedge')
+        self.assertEqual(self._call(primary, hedge), 'primary')
+
+        self.assertEqual(hedge.calls, [])
+        self.assertEqual(self.hedging.hedges, 0)
+        self._assert_released(primary, hedge)
+
+class TestMicroBatcher(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+
+    @tornado.gen.coroutine
+    def _send(self, image_datas, timeout):
+        '''Answers with the first byte of each image, failing for batches
+        with a 'bad' image in them.'''
+        self.sent.append(list(image_datas))
+        yield tornado.gen.moment
+        if 'bad' in image_datas:
+            raise client.PredictionError('bad image')
+        raise tornado.gen.Return(
+            (np.array([[ord(x[0])] for x in image_datas]), 'v1'))
+
+    def _submit(self, batcher, images, timeouts=None):
+        '''Submits the images at the same time.
+
+        Returns: The result or exception for each image
+        '''
+        timeouts = timeouts or [1.0] * len(images)
+
+        @tornado.gen.coroutine
+        def _one(image, timeout):
+            try:
+                result = yield batcher.submit(image, timeout)
+            except Exception as e:
+                raise tornado.gen.Return(e)
+            raise tornado.gen.Return(result)
+
+        @tornado.gen.coroutine
+        def _all():
+            results = yield [_one(x, t) for x, t in zip(images, timeouts)]
+            raise tornado.gen.Return(results)
+        return tornado.ioloop.IOLoop.current().run_sync(_all)
+
+    def test_outputs_go_to_each_caller(self):
+        batcher = client.MicroBatcher(self._send, window=0.01)
+        results = self._submit(batcher, ['a', 'b', 'c'])
+
+        self.assertEqual(self.sent, [['a', 'b', 'c']])
+        self.assertEqual([(list(x[0]), x[1]) for x in results],
+                         [([97], 'v1'), ([98], 'v1'), ([99], 'v1')])
+        self.assertEqual(batcher.stats()['flush_sizes'], {3: 1})
+
+    def test_full_batch_is_sent_early(self):
+        batcher = client.MicroBatcher(self._send, window=10.0, max_images=2)
+        results = self._submit(batcher, ['a', 'b'])
+
+        self.assertEqual(self.sent, [['a', 'b']])
+        self.assertEqual([x[1] for x in results], ['v1', 'v1'])
+
+    def test_failed_batch_only_fails_the_bad_image(self):
+        batcher = client.MicroBatcher(self._send, window=0.01)
+        results = self._submit(batcher, ['a', 'bad', 'c'])
+
+        self.assertEqual(self.sent, [['a', 'bad', 'c'], ['a'], ['bad'],
+                                     ['c']])
+        self.assertEqual(list(results[0][0]), [97])
+        self.assertIsInstance(results[1], client.PredictionError)
+        self.assertEqual(list(results[2][0]), [99])
+        self.assertEqual(batcher.isolated_failures, 1)
+
+    def test_errors_reach_every_caller(self):
+        @tornado.gen.coroutine
+        def _send(image_datas, timeout):
+            self.sent.append(list(image_datas))
+            raise ValueError('server is down')
+        batcher = client.MicroBatcher(_send, window=0.01)
+        results = self._submit(batcher, ['a', 'b', 'c'])
+
+        self.assertEqual(len(self.sent), 4)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(batcher.isolated_failures, 3)
+
+    def test_timeouts_reach_every_caller(self):
+        @tornado.gen.coroutine
+        def _send(image_datas, timeout):
+            self.sent.append(list(image_datas))
+            # Never answers
+            yield tornado.concurrent.Future()
+        batcher = client.MicroBatcher(_send, window=0.01)
+        results = self._submit(batcher, ['a', 'b', 'c'], [0.05] * 3)
+
+        self.assertEqual(self.sent, [['a', 'b', 'c']])
+        for result in results:
+            self.assertIsInstance(result, client.PredictionError)
+
+    def test_timed_out_images_are_not_sent(self):
+        batcher = client.MicroBatcher(self._send, window=0.05)
+        results = self._submit(batcher, ['a', 'b'], [0.01, 1.0])
+
+        self.assertEqual(self.sent, [['b']])
+        self.assertIsInstance(results[0], client.PredictionError)
+        self.assertEqual(list(results[1][0]), [98])
+
+class TestPrepBatch(unittest.TestCase):
+    def test_matches_aquila_prep(self):
+        rs = np.random.RandomState(0)
+        frames = [rs.randint(0, 256, (h, w, 3)).astype(np.uint8)
+                  for h, w in [(360, 640), (480, 640), (300, 900)]]
+        out = np.zeros((4, client._PREPPED_SIZE), dtype=np.uint8)
+        self.assertIs(client.prep_batch(frames, out[:3]).base, out)
+        for i, frame in enumerate(frames):
+            np.testing.assert_array_equal(
+                out[i], client._aquila_prep(frame).reshape(-1))
+        self.assertFalse(out[3].any())
+
+    def test_bad_frame(self):
+        with self.assertRaises(ValueError):
+            client.prep_batch([np.zeros((10, 10), dtype=np.uint8)])
+
+    def test_batch_data_reuses_the_pooled_buffer(self):
+        rs = np.random.RandomState(0)
+        frames = [rs.randint(0, 256, (h, w, 3)).astype(np.uint8)
+                  for h, w in [(360, 640), (300, 900)]]
+        pool = client.RequestBufferPool(max_images=4)
+        data = client._prep_batch_data(frames, pool)
+        self.assertEqual(
+            data, b''.join(client._prep_request_data(x) for x in frames))
+
+        buf = pool._free[0]
+        self.assertEqual(client._prep_batch_data(frames[:1], pool),
+                         data[:client._PREPPED_SIZE])
+        self.assertEqual(len(pool._free), 1)
+        self.assertIs(pool._free[0], buf)
+
+class TestProcessPrep(unittest.TestCase):
+    def setUp(self):
+        self.predictor = client.DeepnetPredictor(
+            aquila_connection=local_server.StaticConnection(),
+            prep_executor='process', prep_workers=2)
+
+    def tearDown(self):
+        self.predictor.shutdown()
+
+    def test_workers_start_with_the_predictor(self):
+        self.assertEqual(
+            len(self.predictor._prep_pool._pool._processes), 2)
+
+    def test_batch_is_prepped_in_the_pool(self):
+        rs = np.random.RandomState(0)
+        images = [rs.randint(0, 256, (h, w, 3)).astype(np.uint8)
+                  for h, w in [(360, 640), (300, 900)]]
+        request = tornado.ioloop.IOLoop.current().run_sync(
+            lambda: self.predictor._prep_batch_request(images))
+
+        self.assertEqual(request.num_images, 2)
+        self.assertEqual(request.image_data, client._prep_batch_data(images))
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.valence = np.arange(4, dtype=np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _disk_cache(self, **kwargs):
+        cache = client.FeatureCache(disk_dir=self.directory, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def test_disk_hit(self):
+        self._disk_cache().put('a', 'v1', self.valence).result()
+        cache = self._disk_cache()
+        valence = cache.get('a', 'v1')
+
+        np.testing.assert_array_equal(valence, self.valence)
+        self.assertNotIsInstance(valence, np.memmap)
+        self.assertEqual(cache.disk_hits, 1)
+
+    def test_bad_file_is_a_miss(self):
+        cache = self._disk_cache(max_bytes=0)
+        cache.put('a', 'v1', self.valence).result()
+        path = cache._disk_path('a', 'v1')
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 4)
+
+        self.assertIsNone(cache.get('a', 'v1'))
+        self.assertEqual(cache.misses, 1)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(cache.stats()['disk_entries'], 0)
+        self.assertEqual(cache.stats()['disk_bytes'], 0)
+
+    def test_disk_hits_share_the_memory_budget(self):
+        cache = self._disk_cache(max_bytes=2 * self.valence.nbytes)
+        for key in ('a', 'b', 'c'):
+            cache.put(key, 'v1', self.valence).result()
+        self.assertIsNotNone(cache.get('a', 'v1'))
+
+        self.assertEqual(cache.stats()['bytes'], 2 * self.valence.nbytes)
+        self.assertEqual(sorted(x[0] for x in cache._entries), ['a', 'c'])
+
+    def test_disk_tier_is_capped(self):
+        cache = self._disk_cache()
+        cache.put('a', 'v1', self.valence).result()
+        cache.max_disk_bytes = 2 * cache.stats()['disk_bytes']
+        for key in ('b', 'c'):
+            cache.put(key, 'v1', self.valence).result()
+
+        self.assertEqual(cache.disk_evictions, 1)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['v1-b.npy', 'v1-c.npy'])
+
+    def test_close(self):
+        cache = self._disk_cache()
+        writer = cache._writer
+        cache.close()
+
+        self.assertIsNone(cache.put('a', 'v1', self.valence))
+        self.assertEqual(os.listdir(self.directory), [])
+        np.testing.assert_array_equal(cache.get('a', 'v1'), self.valence)
+        with self.assertRaises(RuntimeError):
+            writer.submit(time.time)
+
+    def test_predictor_shutdown_closes_cache(self):
+        cache = self._disk_cache()
+        predictor = client.DeepnetPredictor(
+            aquila_connection=local_server.StaticConnection(),
+            feature_cache=cache)
+        predictor.shutdown()
+        self.assertIsNone(cache._writer)
+
+class TestPredictBatch(unittest.TestCase):
+    def setUp(self):
+        self.predictor = client.DeepnetPredictor(
+            aquila_connection=local_server.StaticConnection())
+
+    def tearDown(self):
+        self.predictor.shutdown()
+
+    def test_empty_batch(self):
+        scores, features, vers = self.predictor.predict_batch([])
+        self.assertEqual(scores.shape, (0,))
+        self.assertEqual(features.shape, (0, 0))
+        self.assertEqual(features.dtype, np.float32)
+        self.assertIsNone(vers)
+
+    def test_empty_batch_for_demographics(self):
+        scores, features, vers = self.predictor.predict_batch(
+            [], demographics='all')
+        self.assertEqual(scores.shape, (0, len(client.DEMOGRAPHICS)))
+
+        scores, features, vers = self.predictor.predict_batch(
+            [], demographics=[(None, None), ('M', '18-19')])
+        self.assertEqual(scores.shape, (0, 2))
+
+class _FakeStream(object):
+    '''A RegressStream call that answers every request with the same
+    features.'''
+    def __init__(self, requests):
+        self.requests = requests
+        self.cancelled = False
+
+    def __iter__(self):
+        for request in self.requests:
+            response = aquila_inference_pb2.AquilaResponse()
+            response.features = np.array([0.5], '<f4').tostring()
+            response.features_dtype = '<f4'
+            response.model_version = 'v1'
+            yield response
+
+    def cancel(self):
+        self.cancelled = True
+
+class TestPredictStream(unittest.TestCase):
+    def setUp(self):
+        self.predictor = client.DeepnetPredictor(
+            aquila_connection=local_server.StaticConnection())
+        self.predictor._get_stub = lambda: (self, None)
+        self.predictor._release_stub = lambda backend: None
+        self.images = [np.zeros((10, 10, 3), np.uint8)] * 3
+
+    def tearDown(self):
+        self.predictor.shutdown()
+
+    def RegressStream(self, requests, timeout):
+        self.in_flight = self.predictor.limiter.in_flight
+        return _FakeStream(requests)
+
+    def test_stream_holds_a_limiter_slot(self):
+        self.predictor._ready.set()
+        limit = self.predictor.limiter.limit
+        results = list(self.predictor.predict_stream(self.images, timeout=5))
+
+        self.assertEqual([x[2] for x in results], ['v1'] * 3)
+        self.assertEqual(self.in_flight, 1)
+        self.assertEqual(self.predictor.limiter.in_flight, 0)
+        self.assertEqual(self.predictor.limiter.limit, limit)
+
+    def test_stream_waits_for_a_limiter_slot(self):
+        self.predictor._ready.set()
+        while self.predictor.limiter.try_acquire() is not None:
+            pass
+        in_flight = self.predictor.limiter.in_flight
+        with self.assertRaises(client.ConcurrencyLimitError):
+            list(self.predictor.predict_stream(self.images, timeout=0.05))
+        self.assertEqual(self.predictor.limiter.in_flight, in_flight)
+
+    def test_stream_waits_for_the_server(self):
+        with self.assertRaises(client.PredictionError):
+            list(self.predictor.predict_stream(self.images, timeout=0.05))
+        self.assertEqual(self.predictor.limiter.in_flight, 0)
+
+    def test_stopping_early_frees_the_slot(self):
+        self.predictor._ready.set()
+        stream = self.predictor.predict_stream(self.images, timeout=5)
+        next(stream)
+        stream.close()
+        self.assertEqual(self.predictor.limiter.in_flight, 0)
+
+class TestResponseFeatures(unittest.TestCase):
+    def _response(self, values, dtype):
+        response = aquila_inference_pb2.AquilaResponse()
+        response.features = np.asarray(values).astype(
+            dtype or '<f4').tostring()
+        response.features_dtype = dtype
+        return response
+
+    def test_packed(self):
+        features = client._response_features(
+            self._response([1., 2., 3.], '<f4'), (-1,))
+        np.testing.assert_array_equal(features, [1., 2., 3.])
+        self.assertEqual(features.dtype, np.float32)
+
+    def test_empty_dtype_is_float32(self):
+        features = client._response_features(
+            self._response([1., 2.], ''), (-1,))
+        np.testing.assert_array_equal(features, [1., 2.])
+
+    def test_other_float_dtype(self):
+        features = client._response_features(
+            self._response([1., 2.], '>f8'), (-1,))
+        np.testing.assert_array_equal(features, [1., 2.])
+        self.assertEqual(features.dtype, np.float32)
+
+    def test_bad_dtype(self):
+        for dtype in ['nonsense', '<i4', '|O']:
+            response = self._response([1., 2.], '<f4')
+            response.features_dtype = dtype
+            with self.assertRaises(ValueError):
+                client._response_features(response, (-1,))
+
+    def test_wrong_size(self):
+        response = self._response([1., 2.], '<f4')
+        response.features = response.features[:-1]
+        with self.assertRaises(ValueError):
+            client._response_features(response, (-1,))
+
+class _ReadyChannel(object):
+    '''A channel that reports it is ready as soon as it is subscribed to.'''
+    def __init__(self, channel):
+        self._wrapped = channel
+        self.subscribed = []
+
+    def __getattr__(self, name):
+        return getattr(self._wrapped, name)
+
+    def subscribe(self, callback, try_to_connect=False):
+        self.subscribed.append(callback)
+        callback(client.ChannelConnectivity.READY)
+
+    def unsubscribe(self, callback):
+        self.subscribed.remove(callback)
+
+class TestAquilaChannelPool(unittest.TestCase):
+    def setUp(self):
+        self._insecure_channel = client.implementations.insecure_channel
+        self.channels = []
+        def _channel(host, port):
+            channel = _ReadyChannel(self._insecure_channel(host, port))
+            self.channels.append(channel)
+            return channel
+        client.implementations.insecure_channel = _channel
+
+    def tearDown(self):
+        client.implementations.insecure_channel = self._insecure_channel
+
+    def test_ready_on_subscribe(self):
+        ready = []
+        pool = client.AquilaChannelPool(
+            local_server.StaticConnection(['localhost:1', 'localhost:2']),
+            9000, ready_callback=ready.append)
+        pool.refresh()
+        self.assertEqual(ready, [True])
+        self.assertTrue(all(x['ready'] for x in pool.stats().values()))
+        self.assertIsNotNone(pool.acquire())
+
+        pool.close()
+        self.assertEqual(ready, [True, False])
+        self.assertFalse(any(x.subscribed for x in self.channels))
+
+    def test_provider_with_only_get_ip(self):
+        class _OneServer(object):
+            def get_ip(self, force_refresh=False):
+                return 'localhost:1'
+        pool = client.AquilaChannelPool(_OneServer(), 9000)
+        pool.refresh()
+        self.assertEqual(pool.stats().keys(), ['localhost:1'])
+        pool.close()
+
+class TestIOLoopThread(unittest.TestCase):
+    def setUp(self):
+        self.thread = utils.sync.IOLoopThread(name='test')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.thread.stop()
+        self.thread.join()
+
+    def test_results(self):
+        @tornado.gen.coroutine
+        def _add(x, y):
+            yield tornado.gen.moment
+            raise tornado.gen.Return(x + y)
+        self.assertEqual(self.thread.submit(_add, 1, 2).result(1), 3)
+        with self.assertRaises(ZeroDivisionError):
+            self.thread.submit(lambda: 1 / 0).result(1)
+
+    def test_stop_fails_pending_calls(self):
+        future = self.thread.submit(lambda: tornado.concurrent.Future())
+        self.thread.stop()
+        with self.assertRaises(utils.sync.IOLoopThreadStoppedError):
+            future.result(1)
+        with self.assertRaises(utils.sync.IOLoopThreadStoppedError):
+            self.thread.submit(lambda: 1).result(1)
+
+class SignatureDirTest(unittest.TestCase):
+    '''Runs with a copy of the demographics directory.'''
+    model_name = '20160713-aquilav2'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for ext in ('weight.pkl', 'bias.pkl'):
+            shutil.copy(os.path.join(client._DEMOGRAPHICS_DIR,
+                                     '%s-%s' % (self.model_name, ext)),
+                        self.directory)
+        self._old_dir = client._DEMOGRAPHICS_DIR
+        client._DEMOGRAPHICS_DIR = self.directory
+        client.DemographicSignatures.remove_instance(self.model_name)
+
+    def tearDown(self):
+        client.DemographicSignatures.remove_instance(self.model_name)
+        client._DEMOGRAPHICS_DIR = self._old_dir
+        shutil.rmtree(self.directory)
+
+    def _add_to_bias(self, delta):
+        bias_fn = os.path.join(self.directory, '%s-bias.pkl' % self.model_name)
+        bias = pandas.read_pickle(bias_fn)
+        (bias + delta).to_pickle(bias_fn)
+
+    def _score(self, signatures):
+        X = np.ones((1, signatures._signatures.shape[1]), dtype=np.float32)
+        return signatures.compute_scores_for_demos(X, [(None, None)])[0, 0]
+
+class TestCompiledSignatures(SignatureDirTest):
+    def test_uses_compiled_form(self):
+        client.compile_signatures(self.model_name)
+        signatures = client.DemographicSignatures(self.model_name)
+        self.assertIsInstance(signatures._signatures, np.memmap)
+
+    def test_stale_compiled_form_is_not_used(self):
+        client.compile_signatures(self.model_name)
+        before = self._score(client.DemographicSignatures(self.model_name))
+        client.DemographicSignatures.remove_instance(self.model_name)
+
+        self._add_to_bias(1.0)
+        compiled = client.DemographicSignatures.__new__(
+            client.DemographicSignatures)
+        with self.assertRaises(ValueError):
+            compiled._load_compiled(self.model_name)
+
+        signatures = client.DemographicSignatures(self.model_name)
+        self.assertNotIsInstance(signatures._signatures, np.memmap)
+        self.assertAlmostEqual(self._score(signatures), before + 1.0,
+                               places=5)
+
+    def test_compiled_form_without_pickles(self):
+        client.compile_signatures(self.model_name)
+        for ext in ('weight.pkl', 'bias.pkl'):
+            os.remove(os.path.join(self.directory,
+                                   '%s-%s' % (self.model_name, ext)))
+        signatures = client.DemographicSignatures(self.model_name)
+        self.assertIsInstance(signatures._signatures, np.memmap)
+
+class TestLastUsed(SignatureDirTest):
+    def test_cached_scoring_updates_last_used(self):
+        signatures = client.DemographicSignatures(self.model_name)
+        self._score(signatures)
+
+        signatures.last_used = 0
+        self._score(signatures)
+        self.assertGreater(signatures.last_used, 0)
+
+        signatures.last_used = 0
+        X = np.ones((2, signatures._signatures.shape[1]), dtype=np.float32)
+        signatures.get_scores_for_all_demos_batch(X)
+        signatures.last_used = 0
+        signatures.get_scores_for_all_demos_batch(X)
+        self.assertGreater(signatures.last_used, 0)
+
+class TestSignatureReloader(SignatureDirTest):
+    def test_reloads_edited_pickles(self):
+        client.compile_signatures(self.model_name)
+        old = client.DemographicSignatures(self.model_name)
+        before = self._score(old)
+
+        self._add_to_bias(1.0)
+        reloader = client.SignatureReloader()
+        tornado.ioloop.IOLoop.current().run_sync(reloader.check)
+
+        new = client.DemographicSignatures.get_loaded(self.model_name)
+        self.assertIsNot(new, old)
+        self.assertEqual(reloader.reloads, 1)
+        self.assertAlmostEqual(self._score(new), before + 1.0, places=5)
+        # The compiled form was brought up to date and is used again
+        self.assertIsInstance(new._signatures, np.memmap)
+
+        tornado.ioloop.IOLoop.current().run_sync(reloader.check)
+        self.assertEqual(reloader.reloads, 1)
+        self.assertIs(client.DemographicSignatures.get_loaded(
+            self.model_name), new)
+
+    def test_reloads_without_compiled_form(self):
+        old = client.DemographicSignatures(self.model_name)
+        before = self._score(old)
+
+        self._add_to_bias(1.0)
+        reloader = client.SignatureReloader()
+        tornado.ioloop.IOLoop.current().run_sync(reloader.check)
+
+        new = client.DemographicSignatures.get_loaded(self.model_name)
+        self.assertAlmostEqual(self._score(new), before + 1.0, places=5)
+        self.assertFalse(os.path.exists(client._compiled_signature_paths(
+            self.model_name)[1]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,7 @@ Author: Mark Desnoyer (desnoyer@neon-lab.com)
 '''
 
 import numpy as np
+import threading
 
 def full_object_str(obj, exclude=[]):
     '''Returns a JSON-like object string.
@@ -36,18 +37,75 @@ class KeyedSingleton(type):
     Then, every time you call MyClass(key), you get the same object
 
     The key can be any python object that can be used as a key in a dictionary.
+
+    Creating the objects is thread safe and single flight. If several
+    threads ask for the same new key at once, only one of them builds the
+    object and the others wait for it.
     '''
     _instances = {}
+    _singleton_lock = threading.Lock()
+    # single_key -> threading.Event set when the object being built is done
+    _singleton_building = {}
+
     def __call__(cls, key, *args, **kwargs):
         single_key = (cls, key)
-        if single_key not in cls._instances:
-            if key is not None:
-                cls._instances[single_key] = super(KeyedSingleton, cls).__call__(
-                key, *args, **kwargs)
-            else:
-                cls._instances[single_key] = super(KeyedSingleton, cls).__call__(
-                    *args, **kwargs)
-        return cls._instances[single_key]
+        while True:
+            with KeyedSingleton._singleton_lock:
+                if single_key in cls._instances:
+                    return cls._instances[single_key]
+                event = KeyedSingleton._singleton_building.get(single_key)
+                if event is None:
+                    event = threading.Event()
+                    KeyedSingleton._singleton_building[single_key] = event
+                    break
+            # Someone else is building it. If that fails, try ourselves.
+            event.wait()
+
+        try:
+            instance = cls.create(key, *args, **kwargs)
+            with KeyedSingleton._singleton_lock:
+                cls._instances[single_key] = instance
+            return instance
+        finally:
+            with KeyedSingleton._singleton_lock:
+                del KeyedSingleton._singleton_building[single_key]
+            event.set()
+
+    def create(cls, key, *args, **kwargs):
+        '''Builds a new object for key without registering it.'''
+        if key is not None:
+            return super(KeyedSingleton, cls).__call__(key, *args, **kwargs)
+        return super(KeyedSingleton, cls).__call__(*args, **kwargs)
+
+    def get_loaded(cls, key):
+        '''Returns the object for key if it has been built, otherwise None.
+
+        This never builds the object, so it never blocks on it.
+        '''
+        with KeyedSingleton._singleton_lock:
+            return cls._instances.get((cls, key))
+
+    def loaded_keys(cls):
+        '''Returns the keys of the objects that have been built.'''
+        with KeyedSingleton._singleton_lock:
+            return [key for c, key in cls._instances.keys() if c is cls]
+
+    def replace_instance(cls, key, instance):
+        '''Atomically makes instance the object for key.
+
+        Anyone still holding the old object can keep using it.
+        '''
+        with KeyedSingleton._singleton_lock:
+            cls._instances[(cls, key)] = instance
+
+    def remove_instance(cls, key):
+        '''Forgets the object for key, so it is built again when next
+        asked for.
+
+        Returns: The object that was removed, or None
+        '''
+        with KeyedSingleton._singleton_lock:
+            return cls._instances.pop((cls, key), None)
 
     def _clear_singletons(self):
         '''For unittests only.'''
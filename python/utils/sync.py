@@ -9,12 +9,43 @@ import functools
 import logging
 import threading
 import time
+import tornado.concurrent
 import tornado.gen
 import tornado.httpclient
 import tornado.ioloop
 
 _log = logging.getLogger(__name__)
 
+# IOLoopThread that synchronous calls run on, if use_io_loop_thread() is on
+_sync_thread = None
+_sync_thread_lock = threading.Lock()
+
+def use_io_loop_thread(enable=True):
+    '''Changes how optional_sync functions run synchronous calls.
+
+    By default, each synchronous call runs on a new IOLoop that is closed
+    afterwards. When enabled, the calls are instead run on one long lived
+    IOLoopThread, and the calling thread waits for the result. This avoids
+    building an IOLoop per call, and lets calls from different threads
+    share the coroutines and resources on that IOLoop.
+
+    A synchronous call made from the IOLoopThread itself still gets its own
+    IOLoop, because waiting on the thread from the thread would deadlock.
+
+    Disabling it stops the thread, and calls still waiting on it raise
+    IOLoopThreadStoppedError.
+    '''
+    global _sync_thread
+    with _sync_thread_lock:
+        if enable and _sync_thread is None:
+            _sync_thread = IOLoopThread(name='optional_sync')
+            _sync_thread.daemon = True
+            _sync_thread.start()
+        elif not enable and _sync_thread is not None:
+            _sync_thread.stop()
+            _sync_thread.join()
+            _sync_thread = None
+
 def optional_sync(func):
     '''A decorator that makes an asyncronous function optionally synchronous.
 
@@ -67,6 +98,14 @@ def optional_sync(func):
             if async:
                 return func(*args, **kwargs)
 
+        sync_thread = _sync_thread
+        if (sync_thread is not None and
+                threading.current_thread() is not sync_thread):
+            retval = sync_thread.submit(func, *args, **kwargs).result()
+            if isinstance(retval, Exception):
+                raise retval
+            return retval
+
         with bounded_io_loop() as io_loop:
             retval = io_loop.run_sync(lambda : func(*args, **kwargs))
             if isinstance(retval, Exception):
@@ -104,11 +143,19 @@ def bounded_io_loop():
         client.close() 
         temp_ioloop.close()
 
+class IOLoopThreadStoppedError(RuntimeError):
+    '''Raised for calls on an IOLoopThread that was stopped before they
+    finished.'''
+    pass
+
 class IOLoopThread(threading.Thread):
     '''A thread that just runs an io loop.'''
     def __init__(self, name=None):
         super(IOLoopThread, self).__init__(name=name)
         self.io_loop = tornado.ioloop.IOLoop(make_current=False)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._stopped = False
 
     def __del__(self):
         self.io_loop.close()
@@ -118,7 +165,76 @@ class IOLoopThread(threading.Thread):
         self.io_loop.start()
 
     def stop(self):
-        self.io_loop.stop()
+        '''Stops the io loop. Calls from submit() that haven't finished
+        fail with IOLoopThreadStoppedError, so nobody waits on them
+        forever.'''
+        with self._lock:
+            self._stopped = True
+            pending = list(self._pending)
+            self._pending.clear()
+        # add_callback is the only IOLoop method safe from other threads
+        self.io_loop.add_callback(self.io_loop.stop)
+        for future in pending:
+            _fail_stopped(future, self.name)
+
+    def submit(self, func, *args, **kwargs):
+        '''Runs a function, which may be a coroutine, on the io loop.
+
+        Can be called from any thread.
+
+        Returns: A concurrent.futures.Future of the result
+        '''
+        future = concurrent.futures.Future()
+        with self._lock:
+            stopped = self._stopped
+            if not stopped:
+                self._pending.add(future)
+        if stopped:
+            _fail_stopped(future, self.name)
+            return future
+
+        def _run():
+            try:
+                running = future.set_running_or_notify_cancel()
+            except RuntimeError:
+                # stop() got to it first
+                return
+            if not running:
+                self._claim(future)
+                return
+            try:
+                result = tornado.gen.maybe_future(func(*args, **kwargs))
+            except Exception as e:
+                if self._claim(future):
+                    future.set_exception(e)
+                return
+            result.add_done_callback(lambda x: self._finish(future, x))
+        self.io_loop.add_callback(_run)
+        return future
+
+    def _claim(self, future):
+        '''Returns True if the caller is the one to complete a future from
+        submit(), which is otherwise left to stop().'''
+        with self._lock:
+            if future not in self._pending:
+                return False
+            self._pending.remove(future)
+            return True
+
+    def _finish(self, future, result):
+        if self._claim(future):
+            tornado.concurrent.chain_future(result, future)
+
+def _fail_stopped(future, name):
+    '''Fails a future from IOLoopThread.submit() that wasn't cancelled.'''
+    try:
+        if not future.set_running_or_notify_cancel():
+            return
+    except RuntimeError:
+        # It is already running
+        pass
+    future.set_exception(IOLoopThreadStoppedError(
+        'IOLoopThread %s was stopped' % name))
 
 class LockAquireThread(threading.Thread):
     '''A thread that will set a future when a lock is aquired.'''